@@ -0,0 +1,46 @@
+'''
+Times how long a fresh interpreter takes to import minisparql and parse
+its first query, which is what a one-off -e run pays before it does any
+work, and fails if the median of a number of runs is over budget.
+
+    $ python bench_startup.py [runs]
+'''
+import os
+import subprocess
+import sys
+
+# milliseconds for the import and first parse together
+BUDGET = 100
+
+QUERY = 'PREFIX x: <http://x/> SELECT ?a ?c WHERE { ?a b ?c . OPTIONAL { ?a x:y ?d } FILTER (?c > 0) }'
+
+SCRIPT = '''
+import time
+start = time.time()
+import minisparql
+imported = time.time()
+minisparql.TripleStore().parse_query(%r)
+parsed = time.time()
+print (imported - start) * 1000, (parsed - imported) * 1000
+''' % QUERY
+
+def run():
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    return [float(t) for t in out.split()]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(runs=10):
+    times = [run() for i in range(runs)]
+    imported = median([i for i, p in times])
+    parsed = median([p for i, p in times])
+    total = median([i + p for i, p in times])
+    print 'import %.1fms, first parse %.1fms, total %.1fms (budget %dms)' % \
+          (imported, parsed, total, BUDGET)
+    return total <= BUDGET
+
+if __name__ == '__main__':
+    sys.exit(0 if main(*[int(a) for a in sys.argv[1:]]) else 1)
@@ -1,32 +1,42 @@
 from pyparsing import Word, OneOrMore, alphas, Combine, Regex, Group, Literal, \
                       Optional, ZeroOrMore, CaselessKeyword, Keyword, Forward, \
-                      delimitedList, ParseException, QuotedString, \
-                      operatorPrecedence, opAssoc, oneOf, ParserElement
-
-ParserElement.enablePackrat()
+                      delimitedList, ParseException, ParseBaseException, QuotedString, \
+                      operatorPrecedence, opAssoc, oneOf
 
+import os
 import re
 import sys
+import time
 import operator
-from itertools import islice
+import threading
+from itertools import islice, chain
+from copy import deepcopy
+from bisect import bisect_left, bisect_right
+
+# the grammar is only built when the first query is parsed, so using
+# the module without parsing queries doesn't pay for it
 
-_float = Regex(r'[-+]?\d+\.\d*([eE]\d+)?').setParseAction(lambda s, loc, toks: float(toks[0]))
-_integer = Regex(r'[-+]?\d+').setParseAction(lambda s, loc, toks: int(toks[0]))
-_number = _float | _integer
-_string = QuotedString('"""', escChar='\\', multiline=True) \
-        | QuotedString('\'\'\'', escChar='\\', multiline=True) \
-        | QuotedString('"', escChar='\\') | QuotedString('\'', escChar='\\')
-_full_iri = QuotedString('<', endQuoteChar='>')
-_iri = _full_iri | Combine(Word(alphas) + ':' + Word(alphas))
-_boolean = (Keyword('true') | Keyword('false')).setParseAction(lambda s, loc, toks: toks[0] == 'true')
+def _full_iri():
+    return QuotedString('<', endQuoteChar='>')
 
-_literal = _number | _string | _iri | _boolean | Word(alphas)
+def _literal():
+    float_ = Regex(r'[-+]?\d+\.\d*([eE]\d+)?').setParseAction(lambda s, loc, toks: float(toks[0]))
+    integer = Regex(r'[-+]?\d+').setParseAction(lambda s, loc, toks: int(toks[0]))
+    string = QuotedString('"""', escChar='\\', multiline=True) \
+           | QuotedString('\'\'\'', escChar='\\', multiline=True) \
+           | QuotedString('"', escChar='\\') | QuotedString('\'', escChar='\\')
+    iri = _full_iri() | Combine(Word(alphas) + ':' + Word(alphas))
+    boolean = (Keyword('true') | Keyword('false')).setParseAction(lambda s, loc, toks: toks[0] == 'true')
+    return (float_ | integer) | string | iri | boolean | Word(alphas)
 
 
 def _binOpAction(s, loc, toks):
     group = toks[0]
-    lhs, op, rhs = group
-    return BinaryOperatorExpression(lhs, op, rhs)
+    # operators of the same precedence come through as one flat group
+    expression = group[0]
+    for i in range(1, len(group), 2):
+        expression = BinaryOperatorExpression(expression, group[i], group[i + 1])
+    return expression
 
 def _unaryOpAction(s, loc, toks):
     group = toks[0]
@@ -36,7 +46,7 @@ def _unaryOpAction(s, loc, toks):
 def _expression_parser():
     variable = Combine(Literal('?').suppress() + Word(alphas)) \
                 .setParseAction(lambda s, loc, toks: VariableExpression(toks[0]))
-    literal = _literal.copy().setParseAction(lambda s, loc, toks: LiteralExpression(toks[0]))
+    literal = _literal().setParseAction(lambda s, loc, toks: LiteralExpression(toks[0]))
         
     value = variable | literal
     
@@ -60,11 +70,75 @@ def _expression_parser():
     ])
     return (Literal('(').suppress() + expr + Literal(')').suppress()) | funcCall
 
-def _query_parser(store):
-    prefixes = {}
+class _ParseState(object):
+    # the grammar is shared, so queries are parsed one at a time under the lock
+    CACHE_SIZE = 20000
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.grammar = None
+        self.store = None
+        self.prefixes = {}
+        self.cache = {}
+
+_parse_state = _ParseState()
+
+def _parse_query(store, q):
+    state = _parse_state
+    with state.lock:
+        if state.grammar is None:
+            state.grammar = _memoize(_query_parser())
+        state.store = store
+        state.prefixes = {}
+        try:
+            return state.grammar.parseString(q)
+        finally:
+            state.store = None
+            state.cache.clear()
+
+def _memoize(grammar):
+    grammar.streamline()
+    seen = set()
+    elements = [grammar]
+    while elements:
+        element = elements.pop()
+        if id(element) in seen:
+            continue
+        seen.add(id(element))
+        element._parse = _memoized(element)
+        elements.extend(getattr(element, 'exprs', ()))
+        if getattr(element, 'expr', None) is not None:
+            elements.append(element.expr)
+    return grammar
+
+def _memoized(element):
+    parse = element._parseNoCache
+    def memoized(instring, loc, doActions=True, callPreParse=True):
+        cache = _parse_state.cache
+        key = (element, loc, callPreParse, doActions)
+        try:
+            value = cache[key]
+        except KeyError:
+            if len(cache) >= _ParseState.CACHE_SIZE:
+                cache.clear()
+            try:
+                value = parse(instring, loc, doActions, callPreParse)
+            except ParseBaseException, e:
+                cache[key] = e
+                raise
+            cache[key] = (value[0], value[1].copy())
+            return value
+        if isinstance(value, Exception):
+            raise value
+        # the results are added to by whatever the match is part of
+        return value[0], value[1].copy()
+    return memoized
+
+def _query_parser():
+    state = _parse_state
     
     def add_prefix(prefix, iri):
-        prefixes[prefix] = iri
+        state.prefixes[prefix] = iri
     
     def insert_prefixes(pattern):
         return tuple(insert_prefix(p) for p in pattern)
@@ -73,9 +147,9 @@ def _query_parser(store):
         if isinstance(p, LiteralExpression):
             value = p.value
             if isinstance(value, basestring):
-                for prefix in prefixes:
+                for prefix in state.prefixes:
                     if value.startswith(prefix):
-                        iri = prefixes[prefix]
+                        iri = state.prefixes[prefix]
                         p.value = iri + value[len(prefix):]
                         break
         return p
@@ -84,7 +158,7 @@ def _query_parser(store):
                 .setParseAction(lambda s, loc, toks: VariableExpression(toks[0]))
     variables = OneOrMore(variable)
     
-    literal = _literal.copy().setParseAction(lambda s, loc, toks: LiteralExpression(toks[0]))
+    literal = _literal().setParseAction(lambda s, loc, toks: LiteralExpression(toks[0]))
     
     triple_value = variable | literal
     
@@ -93,8 +167,40 @@ def _query_parser(store):
             return PatternGroup(toks)
         return toks
     
-    triple = (triple_value + triple_value + triple_value)\
-                .setParseAction(lambda s, loc, toks: Pattern(store, *(insert_prefixes(toks))))
+    def as_path(p):
+        if isinstance(p, LiteralExpression):
+            return LinkPath(insert_prefix(p).value)
+        return p
+    
+    def path_element(s, loc, toks):
+        if len(toks) == 1:
+            return toks
+        return RepeatPath(as_path(toks[0]), toks[1])
+    
+    def path_of(cls):
+        def action(s, loc, toks):
+            if len(toks) == 1:
+                return toks
+            return cls([as_path(t) for t in toks])
+        return action
+    
+    path = Forward()
+    path_primary = literal | (Literal('(').suppress() + path + Literal(')').suppress())
+    path_modifier = Regex(r'[*+?](?![A-Za-z])').leaveWhitespace()
+    path_element = (path_primary + Optional(path_modifier)).setParseAction(path_element)
+    path_inverse = (Literal('^').suppress() + path_element) \
+                    .setParseAction(lambda s, loc, toks: InversePath(as_path(toks[0])))
+    path_sequence = delimitedList(path_inverse | path_element, delim='/') \
+                    .setParseAction(path_of(SequencePath))
+    path << delimitedList(path_sequence, delim='|').setParseAction(path_of(AlternativePath))
+    
+    def make_pattern(s, loc, toks):
+        pattern = insert_prefixes(toks)
+        if isinstance(pattern[1], LiteralExpression) or isinstance(pattern[1], VariableExpression):
+            return Pattern(state.store, *pattern)
+        return PathPattern(state.store, *pattern)
+    
+    triple = (triple_value + (variable | path) + triple_value).setParseAction(make_pattern)
     triples_block = delimitedList(triple,
                         delim=Optional(Literal('.').suppress())) \
                         .setParseAction(group_if_multiple) \
@@ -103,11 +209,11 @@ def _query_parser(store):
     group_pattern = Forward().setParseAction(group_if_multiple)
     
     def possible_union_group(s, loc, toks):
-        if len(toks) == 3:
-            return UnionGroup(toks[0], toks[-1])
+        if len(toks) > 1:
+            return UnionGroup(*toks)
         return toks
     
-    group_or_union_pattern = (group_pattern + Optional(CaselessKeyword('UNION') + group_pattern)) \
+    group_or_union_pattern = (group_pattern + ZeroOrMore(CaselessKeyword('UNION').suppress() + group_pattern)) \
                                 .setParseAction(possible_union_group)
     optional_graph_pattern = (CaselessKeyword('OPTIONAL').suppress() + group_pattern) \
                                 .setParseAction(lambda s, loc, toks: OptionalGroup(toks[0]))
@@ -117,14 +223,17 @@ def _query_parser(store):
     filter_pattern = (CaselessKeyword('FILTER').suppress() + filter_expression) \
                         .setParseAction(lambda s, loc, toks: Filter(toks[0]))
     
-    not_triples_pattern = optional_graph_pattern | group_or_union_pattern | filter_pattern
+    graph_graph_pattern = (CaselessKeyword('GRAPH').suppress() + (variable | literal) + group_pattern) \
+                            .setParseAction(lambda s, loc, toks: GraphGroup(state.store, insert_prefix(toks[0]), toks[1]))
+    
+    not_triples_pattern = optional_graph_pattern | graph_graph_pattern | group_or_union_pattern | filter_pattern
     
     group_pattern << (Literal('{').suppress() + \
                       (Optional(triples_block) + ZeroOrMore(not_triples_pattern) + Optional(triples_block)) + \
                       Literal('}').suppress())
     
     prefix = Group(CaselessKeyword('PREFIX').suppress() +
-                    (Combine(Word(alphas) + ':').setResultsName('name') + _full_iri.setResultsName('value'))\
+                    (Combine(Word(alphas) + ':').setResultsName('name') + _full_iri().setResultsName('value'))\
                         .setParseAction(lambda s, loc, toks: add_prefix(toks[0], toks[1]))
                   )
 
@@ -145,9 +254,17 @@ def _query_parser(store):
     limit = (CaselessKeyword('LIMIT').suppress() + Regex(r'\d+').setParseAction(lambda s, loc, toks: Limit(toks[0])))
     offset = (CaselessKeyword('OFFSET').suppress() + Regex(r'\d+').setParseAction(lambda s, loc, toks: Offset(toks[0])))
     
+    def with_dataset(s, loc, toks):
+        if len(toks) > 1:
+            return Dataset([insert_prefix(t).value for t in toks[:-1]], toks[-1])
+        return toks
+    
+    where_clause = (ZeroOrMore(CaselessKeyword('FROM').suppress() + literal) + \
+                    CaselessKeyword('WHERE').suppress() + group_pattern).setParseAction(with_dataset)
+    
     select_query = Group(CaselessKeyword('SELECT').suppress() + Optional(CaselessKeyword('DISTINCT'))) + \
                    Group(variables | Keyword('*')) + \
-                   CaselessKeyword('WHERE').suppress() + group_pattern + \
+                   where_clause + \
                    Optional(order_by) + \
                    ((Optional(limit) + Optional(offset)) \
                   | (Optional(offset) + Optional(limit)))
@@ -165,28 +282,126 @@ def _uniq(l):
             seen.add(i)
     return u
 
+class QueryError(Exception):
+    pass
+
+class QueryTimeout(QueryError):
+    pass
+
+class QueryTooLarge(QueryError):
+    pass
+
+class QueryCancelled(QueryError):
+    pass
+
+
+class QueryLimits(object):
+    def __init__(self, timeout=None, max_rows=None, max_memory=None):
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_memory = max_memory
+
+
+def _solution_size(solution):
+    values = getattr(solution, 'values', None)
+    if values is not None:
+        solution = values()
+    return sys.getsizeof(solution) + sum(sys.getsizeof(v) for v in solution)
+
+
+class _QueryGuard(object):
+    # resources used by one run of a query, checked from the inner loops
+    
+    def __init__(self, limits):
+        self.deadline = None
+        if limits.timeout is not None:
+            self.deadline = time.time() + limits.timeout
+        self.max_rows = limits.max_rows
+        self.max_memory = limits.max_memory
+        self.rows = 0
+        self.memory = 0
+        self.ticks = 0
+        self.cancelled = False
+    
+    def check(self):
+        self.ticks += 1
+        # looking at the clock on every tick would cost more than the work
+        if not self.ticks & 0xff:
+            if self.cancelled:
+                raise QueryCancelled()
+            if self.deadline is not None and time.time() > self.deadline:
+                raise QueryTimeout('query ran for longer than its time limit')
+    
+    def add_row(self):
+        self.rows += 1
+        if self.max_rows is not None and self.rows > self.max_rows:
+            raise QueryTooLarge('query produced more than %d intermediate rows' % self.max_rows)
+        self.check()
+    
+    def add_buffered(self, solution):
+        if self.max_memory is not None:
+            self.memory += _solution_size(solution)
+            if self.memory > self.max_memory:
+                raise QueryTooLarge('query buffered more than %d bytes of solutions' % self.max_memory)
+        self.check()
+
+
+# the guard for the query being run by the current thread, generators
+# pick it up when they start so they don't have to be handed it
+_active = threading.local()
+
+def _current_guard():
+    return getattr(_active, 'guard', None)
+
+
 class SelectQuery(object):
-    def __init__(self, distinct, variables, patterns, order_by, limit, offset):
+    def __init__(self, distinct, variables, patterns, order_by, limit, offset, limits=None,
+                 planned=None):
         self.distinct = distinct
         if len(variables) == 1 and variables[0] == '*':
             variables = patterns.variables
         self.variables = tuple(_uniq(variables))
-        self.patterns = patterns
+        if planned is None:
+            planned = patterns.plan()
+        self.patterns = planned
         self.order_by = order_by
         self.limit = limit
         self.offset = offset or 0
+        self.limits = limits or QueryLimits()
+        self._guard = None
+    
+    def cancel(self):
+        if self._guard is not None:
+            self._guard.cancelled = True
     
     def _distinct(self, matches):
-        matches = sorted(matches)
-        prev = None
+        guard = _current_guard()
+        variables = self.variables
+        seen = set()
         for m in matches:
-            if prev != m:
+            key = tuple(v.resolve(m) for v in variables)
+            if key not in seen:
+                if guard is not None:
+                    guard.add_buffered(key)
+                seen.add(key)
                 yield m
-            prev = m
     
     def __iter__(self):
+        guard = self._guard = _QueryGuard(self.limits)
+        rows = self._rows()
+        while True:
+            _active.guard = guard
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                _active.guard = None
+            yield row
+    
+    def _rows(self):
         variables = self.variables
-        matches = self.patterns.match({})
+        matches = self.patterns.match(Solution())
         if self.distinct:
             matches = self._distinct(matches)
         if self.order_by is not None:
@@ -202,59 +417,931 @@ class SelectQuery(object):
             yield tuple(v.resolve(match) for v in variables)
 
 
+class Solution(object):
+    # bindings kept as a chain, so extending a solution shares what it extends
+    __slots__ = ('parent', 'name', 'value')
+    
+    def __init__(self, parent=None, name=None, value=None):
+        self.parent = parent
+        self.name = name
+        self.value = value
+    
+    @classmethod
+    def from_dict(cls, d):
+        s = cls()
+        for name, value in d.items():
+            s = cls(s, name, value)
+        return s
+    
+    def get(self, name, default=None):
+        s = self
+        while s is not None:
+            if s.name == name:
+                return s.value
+            s = s.parent
+        return default
+    
+    def __getitem__(self, name):
+        s = self
+        while s is not None:
+            if s.name == name:
+                return s.value
+            s = s.parent
+        raise KeyError(name)
+    
+    def __contains__(self, name):
+        return self.get(name, _missing) is not _missing
+    
+    def items(self):
+        items = []
+        seen = set()
+        s = self
+        while s.parent is not None:
+            if s.name not in seen:
+                items.append((s.name, s.value))
+                seen.add(s.name)
+            s = s.parent
+        items.reverse()
+        return items
+    
+    def keys(self):
+        return [name for name, _ in self.items()]
+    
+    def values(self):
+        return [value for _, value in self.items()]
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.items())
+    
+    def to_dict(self):
+        return dict(self.items())
+    
+    def __eq__(self, other):
+        if isinstance(other, (Solution, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+    
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+    
+    def __cmp__(self, other):
+        return cmp(self.to_dict(), dict(other.items()))
+    
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+    
+    def __repr__(self):
+        return 'Solution(%r)' % self.to_dict()
+
+_missing = object()
+
+
+def _solution(existing):
+    if existing is None:
+        return Solution()
+    if isinstance(existing, Solution):
+        return existing
+    return Solution.from_dict(existing)
+
+
+class _Unbound(object):
+    __slots__ = ()
+    
+    def __repr__(self):
+        return 'UNBOUND'
+
+# stands for an unbound position in the triples given to Index.match
+# and the stores, where None or a false value could be mistaken for one
+UNBOUND = _Unbound()
+
+# the positions left unbound in each shape of pattern, a mask of the
+# bound positions with bit i set when position i is bound
+_FREE_POSITIONS = tuple(tuple(i for i in (0, 1, 2) if not mask & (1 << i)) for mask in range(8))
+
+def _resolve_pattern(pattern, existing):
+    # the triple a pattern stands for given a solution, and its shape
+    s, p, o = pattern
+    s = s.resolve(existing)
+    p = p.resolve(existing)
+    o = o.resolve(existing)
+    mask = (s is not None) | (p is not None) << 1 | (o is not None) << 2
+    if mask != 7:
+        if s is None:
+            s = UNBOUND
+        if p is None:
+            p = UNBOUND
+        if o is None:
+            o = UNBOUND
+    return (s, p, o), mask
+
+def _unbound_slots(pattern, mask):
+    return [(i, pattern[i].name) for i in _FREE_POSITIONS[mask]]
+
+
+def _bind(existing, slots, triple):
+    s = existing
+    for i, name in slots:
+        s = Solution(s, name, triple[i])
+    return s
+
+
+# the operator tree and expressions use __slots__ and work out their
+# variables up front, as prepared queries can be kept around in bulk
+
 class Pattern(object):
+    __slots__ = ('store', 'pattern', 'variables')
+    
     def __init__(self, store, a, b, c):
         self.store = store
         self.pattern = (a, b, c)
-    
-    @property
-    def variables(self):
-        return [v for v in self.pattern if getattr(v, 'name', None)]
+        self.variables = tuple(v for v in self.pattern if getattr(v, 'name', None))
     
     def match(self, solution=None):
-        for m in self.store.match_triples(self.pattern, solution):
-            yield m
+        return self.store.match_triples(self.pattern, solution)
+    
+    def plan(self):
+        return self
     
     def __repr__(self):
         return 'Pattern(%s, %s, %s)' % self.pattern
 
-class PatternGroup(object):
+
+class RangePattern(Pattern):
+    # object limited to a range by a later filter
+    __slots__ = ('low', 'high')
+    
+    def __init__(self, pattern, low, high):
+        Pattern.__init__(self, pattern.store, *pattern.pattern)
+        self.low = low
+        self.high = high
+    
+    def match(self, solution=None):
+        solution = _solution(solution)
+        s, p, o = self.pattern
+        if s.resolve(solution) is None and o.resolve(solution) is None:
+            return self.store.match_range(self.pattern, _resolve_bound(self.low),
+                                          _resolve_bound(self.high), solution)
+        return self.store.match_triples(self.pattern, solution)
+    
+    def __repr__(self):
+        return 'RangePattern(%s, %s, %s, %r, %r)' % (self.pattern + (self.low, self.high))
+
+
+class TextPattern(Pattern):
+    # object limited by a later regex() or contains() filter
+    __slots__ = ('search',)
+    
+    def __init__(self, pattern, search):
+        Pattern.__init__(self, pattern.store, *pattern.pattern)
+        self.search = search
+    
+    def match(self, solution=None):
+        solution = _solution(solution)
+        s, p, o = self.pattern
+        if s.resolve(solution) is None and o.resolve(solution) is None:
+            fn = self.search.fn
+            args = [a.resolve(solution) for a in self.search.args[1:]]
+            fragment = args[0]
+            if fn is regex:
+                fragment = _required_literal(*args)
+            # the filter rejects anything else, after a plain match
+            if isinstance(fragment, basestring):
+                test = lambda value: fn(value, *args)
+                return self.store.match_text(self.pattern, fragment, test, solution)
+        return self.store.match_triples(self.pattern, solution)
+    
+    def __repr__(self):
+        return 'TextPattern(%s, %s, %s)' % self.pattern
+
+
+class PathPattern(Pattern):
+    __slots__ = ()
+    
+    def match(self, solution=None):
+        return self.store.match_path(self.pattern, solution)
+    
+    def __repr__(self):
+        return 'PathPattern(%s, %r, %s)' % self.pattern
+
+
+def _step(step, store, nodes):
+    for node in nodes:
+        for n in step(store, node):
+            yield n
+
+class LinkPath(object):
+    __slots__ = ('predicate',)
+    
+    def __init__(self, predicate):
+        self.predicate = predicate
+    
+    def forward(self, store, node):
+        return store._objects(node, self.predicate)
+    
+    def backward(self, store, node):
+        return store._subjects(self.predicate, node)
+    
+    def pairs(self, store):
+        return store._pairs(self.predicate)
+    
+    def __repr__(self):
+        return 'LinkPath(%r)' % (self.predicate,)
+
+
+class InversePath(object):
+    __slots__ = ('path',)
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def forward(self, store, node):
+        return self.path.backward(store, node)
+    
+    def backward(self, store, node):
+        return self.path.forward(store, node)
+    
+    def pairs(self, store):
+        return ((b, a) for a, b in self.path.pairs(store))
+    
+    def __repr__(self):
+        return 'InversePath(%r)' % (self.path,)
+
+
+class SequencePath(object):
+    __slots__ = ('paths',)
+    
+    def __init__(self, paths):
+        self.paths = tuple(paths)
+    
+    def forward(self, store, node):
+        nodes = (node,)
+        for path in self.paths:
+            nodes = _step(path.forward, store, nodes)
+        return nodes
+    
+    def backward(self, store, node):
+        nodes = (node,)
+        for path in reversed(self.paths):
+            nodes = _step(path.backward, store, nodes)
+        return nodes
+    
+    def pairs(self, store):
+        rest = SequencePath(self.paths[1:])
+        for a, b in self.paths[0].pairs(store):
+            for c in rest.forward(store, b):
+                yield a, c
+    
+    def __repr__(self):
+        return 'SequencePath(%r)' % (list(self.paths),)
+
+
+class AlternativePath(object):
+    __slots__ = ('paths',)
+    
+    def __init__(self, paths):
+        self.paths = tuple(paths)
+    
+    def forward(self, store, node):
+        return chain.from_iterable(p.forward(store, node) for p in self.paths)
+    
+    def backward(self, store, node):
+        return chain.from_iterable(p.backward(store, node) for p in self.paths)
+    
+    def pairs(self, store):
+        return chain.from_iterable(p.pairs(store) for p in self.paths)
+    
+    def __repr__(self):
+        return 'AlternativePath(%r)' % (list(self.paths),)
+
+
+class RepeatPath(object):
+    # followed ?, * or + times, breadth first so cycles end the search
+    __slots__ = ('path', 'modifier', 'key')
+    
+    def __init__(self, path, modifier):
+        self.path = path
+        self.modifier = modifier
+        self.key = repr(self)
+    
+    def forward(self, store, node):
+        return store._closure(self, node, self.path.forward)
+    
+    def backward(self, store, node):
+        return store._closure(self, node, self.path.backward)
+    
+    def pairs(self, store):
+        if self.modifier == '+':
+            starts = _uniq(a for a, b in self.path.pairs(store))
+        else:
+            starts = store._nodes()
+        for a in starts:
+            for b in self.forward(store, a):
+                yield a, b
+    
+    def reachable(self, store, node, step):
+        guard = _current_guard()
+        seen = set()
+        if self.modifier != '+':
+            seen.add(node)
+            yield node
+        frontier = [node]
+        while frontier:
+            reached = []
+            for n in frontier:
+                for m in step(store, n):
+                    if guard is not None:
+                        guard.check()
+                    if m not in seen:
+                        seen.add(m)
+                        reached.append(m)
+                        yield m
+            if self.modifier == '?':
+                break
+            frontier = reached
+    
+    def __repr__(self):
+        return 'RepeatPath(%r, %r)' % (self.path, self.modifier)
+
+
+class ShardedStar(object):
+    # patterns on one subject variable, matched shard by shard
+    __slots__ = ('store', 'subject', 'groups', 'variables')
+    
     def __init__(self, patterns):
-        self.patterns = patterns
+        self.store = patterns[0].store
+        self.subject = patterns[0].pattern[0]
+        self.groups = tuple(PatternGroup([Pattern(shard, *p.pattern) for p in patterns]).plan()
+                            for shard in self.store.shards)
+        self.variables = self.groups[0].variables
+    
+    def match(self, solution=None):
+        solution = _solution(solution)
+        subject = self.subject.resolve(solution)
+        if subject is not None:
+            return self.groups[self.store._shard_number(subject)].match(solution)
+        return chain.from_iterable(g.match(solution) for g in self.groups)
+    
+    def plan(self):
+        return self
+    
+    def __repr__(self):
+        return 'ShardedStar(%r)' % (self.groups[0],)
+
+
+class StarJoin(object):
+    # patterns on one subject variable with fixed predicates
+    __slots__ = ('store', 'subject', 'patterns', 'variables')
+    
+    def __init__(self, patterns):
+        self.store = patterns[0].store
+        self.subject = patterns[0].pattern[0]
+        self.patterns = tuple(patterns)
+        self.variables = PatternGroup(patterns).variables
+    
+    def match(self, solution=None):
+        return self.store.match_star(self.subject,
+                                     [p.pattern[1:] for p in self.patterns],
+                                     solution)
+    
+    def plan(self):
+        return self
+    
+    def __repr__(self):
+        return 'StarJoin(%r)' % (list(self.patterns),)
+
+
+class TrieJoin(object):
+    # patterns whose variables form a cycle, joined one variable at a time
+    __slots__ = ('store', 'patterns', 'order', 'variables')
     
-    @property
-    def variables(self):
+    def __init__(self, patterns):
+        self.store = patterns[0].store
+        self.patterns = tuple(patterns)
+        self.variables = PatternGroup(patterns).variables
+        self.order = _variable_order(patterns)
+    
+    def match(self, solution=None):
+        return self.store.match_join([p.pattern for p in self.patterns], self.order, solution)
+    
+    def plan(self):
+        return self
+    
+    def __repr__(self):
+        return 'TrieJoin(%r)' % (list(self.patterns),)
+
+
+def _variable_order(patterns):
+    # start with the variable in the most patterns, then keep taking
+    # the one sharing the most patterns with those already taken
+    names = [[v.name for v in p.variables] for p in patterns]
+    counts = {}
+    for n in names:
+        for name in n:
+            counts[name] = counts.get(name, 0) + 1
+    remaining = _uniq(name for n in names for name in n)
+    order = []
+    while remaining:
+        def score(name):
+            shared = sum(1 for n in names if name in n and any(o in n for o in order))
+            return (shared, counts[name])
+        best = max(remaining, key=score)
+        order.append(best)
+        remaining.remove(best)
+    return tuple(order)
+
+def _is_cyclic(patterns):
+    # union-find over the variables, each pair joined by a pattern an
+    # edge; an edge inside one component closes a cycle
+    parent = {}
+    def find(name):
+        while parent.get(name, name) != name:
+            name = parent[name]
+        return name
+    pairs = _uniq(frozenset((p.pattern[0].name, p.pattern[2].name)) for p in patterns)
+    for pair in pairs:
+        x, y = pair
+        a, b = find(x), find(y)
+        if a == b:
+            return True
+        parent[a] = b
+    return False
+
+def _joinable(pattern):
+    s, p, o = pattern.pattern
+    return isinstance(s, VariableExpression) and isinstance(p, LiteralExpression) \
+           and isinstance(o, VariableExpression) and s.name != o.name
+
+def _plan_cycles(patterns):
+    planned = []
+    for run in _pattern_runs(patterns):
+        if not isinstance(run, list):
+            planned.append(run)
+            continue
+        if hasattr(run[0].store, 'match_join'):
+            edges = [p for p in run if _joinable(p) and p.store is run[0].store]
+            if _is_cyclic(edges):
+                planned.append(TrieJoin(edges))
+                run = [p for p in run if p not in edges]
+        planned.extend(run)
+    return planned
+
+
+class ViewPattern(object):
+    __slots__ = ('view', 'terms', 'variables')
+    
+    def __init__(self, view, terms):
+        self.view = view
+        self.terms = tuple(terms)
+        self.variables = tuple(t for t in self.terms if isinstance(t, VariableExpression))
+    
+    def match(self, solution=None):
+        solution = _solution(solution)
+        values = [t.resolve(solution) for t in self.terms]
+        unbound = [(i, t.name) for i, t in enumerate(self.terms) if values[i] is None]
+        bound = [(i, value) for i, value in enumerate(values) if value is not None]
+        guard = _current_guard()
+        for row in self.view.rows_with(bound):
+            if guard is not None:
+                guard.check()
+            if all(row[i] == value for i, value in bound):
+                m = solution
+                for i, name in unbound:
+                    m = Solution(m, name, row[i])
+                yield m
+    
+    def plan(self):
+        return self
+    
+    def __repr__(self):
+        return 'ViewPattern(%r, %r)' % (self.view.name, list(self.terms))
+
+
+def _same_term(a, b):
+    if isinstance(a, VariableExpression):
+        return isinstance(b, VariableExpression) and a.name == b.name
+    return isinstance(b, LiteralExpression) and type(a.value) is type(b.value) \
+           and a.value == b.value
+
+def _unify(view_pattern, pattern, mapping):
+    # extend the mapping from the view's variables to the query's terms
+    mapping = dict(mapping)
+    for v, q in zip(view_pattern, pattern):
+        if isinstance(v, VariableExpression):
+            if v.name in mapping:
+                if not _same_term(mapping[v.name], q):
+                    return None
+            elif isinstance(q, VariableExpression) and \
+                 any(_same_term(t, q) for t in mapping.values()):
+                return None
+            else:
+                mapping[v.name] = q
+        elif not _same_term(v, q):
+            return None
+    return mapping
+
+def _view_match(view, run, used=(), mapping=None):
+    # find patterns in the run the view's patterns can be renamed to
+    k = len(used)
+    if k == len(view.patterns):
+        return used, mapping
+    for j, p in enumerate(run):
+        if j in used or p.store is not view.store:
+            continue
+        m = _unify(view.patterns[k].pattern, p.pattern, mapping or {})
+        if m is not None:
+            found = _view_match(view, run, used + (j,), m)
+            if found is not None:
+                return found
+    return None
+
+def _plan_views(patterns):
+    planned = []
+    for run in _pattern_runs(patterns):
+        if not isinstance(run, list):
+            planned.append(run)
+            continue
+        views = getattr(run[0].store, '_views', None)
+        if views:
+            for view in sorted(views.values(), key=lambda v: -len(v.patterns)):
+                live = [j for j, p in enumerate(run) if type(p) is Pattern]
+                found = _view_match(view, [run[j] for j in live])
+                if found is None:
+                    continue
+                used, mapping = found
+                used = [live[j] for j in used]
+                run[min(used)] = ViewPattern(view, [mapping[name] for name in view.names])
+                for j in used:
+                    if j != min(used):
+                        run[j] = None
+        planned.extend(p for p in run if p is not None)
+    return planned
+
+def _resolve_bound(bound):
+    if bound is None:
+        return None
+    expression, inclusive = bound
+    return expression.value, inclusive
+
+_FLIPPED = { operator.lt: operator.gt, operator.gt: operator.lt,
+             operator.le: operator.ge, operator.ge: operator.le,
+             operator.eq: operator.eq }
+
+def _range_bounds(expression, bounds):
+    # bounds on variables from the comparisons joined by && in a filter
+    if not isinstance(expression, BinaryOperatorExpression):
+        return
+    op = expression.operator
+    if op is BinaryOperatorExpression.OPERATORS['&&']:
+        _range_bounds(expression.lhs, bounds)
+        _range_bounds(expression.rhs, bounds)
+        return
+    if op not in _FLIPPED:
+        return
+    lhs, rhs = expression.lhs, expression.rhs
+    if isinstance(lhs, LiteralExpression) and isinstance(rhs, VariableExpression):
+        lhs, rhs, op = rhs, lhs, _FLIPPED[op]
+    if not (isinstance(lhs, VariableExpression) and isinstance(rhs, LiteralExpression)):
+        return
+    low, high = bounds.get(lhs.name, (None, None))
+    if op in (operator.gt, operator.ge, operator.eq):
+        low = _tighter(low, (rhs, op is not operator.gt), operator.gt)
+    if op in (operator.lt, operator.le, operator.eq):
+        high = _tighter(high, (rhs, op is not operator.lt), operator.lt)
+    bounds[lhs.name] = (low, high)
+
+def _tighter(current, bound, better):
+    if current is None or better(bound[0].value, current[0].value):
+        return bound
+    if bound[0].value == current[0].value and not bound[1]:
+        return bound
+    return current
+
+def _text_searches(expression, searches):
+    # regex() and contains() calls with literal arguments joined by && in a filter
+    if isinstance(expression, BinaryOperatorExpression):
+        if expression.operator is BinaryOperatorExpression.OPERATORS['&&']:
+            _text_searches(expression.lhs, searches)
+            _text_searches(expression.rhs, searches)
+    elif isinstance(expression, FunctionCallExpression) \
+            and expression.fn in (regex, contains) \
+            and len(expression.args) > 1 \
+            and isinstance(expression.args[0], VariableExpression) \
+            and all(isinstance(a, LiteralExpression) for a in expression.args[1:]):
+        searches.setdefault(expression.args[0].name, expression)
+
+def _required_literal(pattern, flags=None):
+    # the longest run of characters every match of the regex contains
+    if not isinstance(pattern, basestring) or \
+       (flags is not None and not isinstance(flags, basestring)):
+        return None
+    if '|' in pattern or (flags and 'x' in flags.lower()):
+        return None
+    runs = []
+    run = []
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\' and i + 1 < len(pattern):
+            i += 1
+            ch = pattern[i]
+            if ch.isalnum():
+                ch = None
+        elif ch in '*?{':
+            # the character before a quantifier that allows zero of it
+            # isn't required after all
+            if run:
+                run.pop()
+            if ch == '{':
+                i = pattern.find('}', i)
+                if i == -1:
+                    return None
+            ch = None
+        elif ch == '[':
+            i = pattern.find(']', i + 2)
+            if i == -1:
+                return None
+            ch = None
+        elif ch in '()':
+            depth += ch == '(' and 1 or -1
+            ch = None
+        elif ch in '.^$+':
+            ch = None
+        if ch is None or depth:
+            runs.append(''.join(run))
+            run = []
+        else:
+            run.append(ch)
+        i += 1
+    runs.append(''.join(run))
+    fragment = max(runs, key=len)
+    if len(fragment) < _TextIndex.GRAM:
+        return None
+    return fragment
+
+def _binds_object(pattern, name):
+    if type(pattern) is not Pattern:
+        return False
+    s, p, o = pattern.pattern
+    return isinstance(s, VariableExpression) and s.name != name \
+           and isinstance(p, LiteralExpression) \
+           and isinstance(o, VariableExpression) and o.name == name
+
+def _pattern_runs(patterns):
+    # runs of adjacent plain patterns, which can be joined in any order
+    run = []
+    for p in patterns:
+        if type(p) is Pattern:
+            run.append(p)
+        else:
+            if run:
+                yield run
+                run = []
+            yield p
+    if run:
+        yield run
+
+def _subject_stars(run):
+    # group the patterns of a run by subject variable, in the order
+    # each subject first appears
+    stars = []
+    by_subject = {}
+    for p in run:
+        subject = p.pattern[0]
+        if isinstance(subject, VariableExpression):
+            key = (subject.name, id(p.store))
+            if key in by_subject:
+                by_subject[key].append(p)
+                continue
+            by_subject[key] = [p]
+            stars.append(by_subject[key])
+        else:
+            stars.append([p])
+    return stars
+
+def _star_operator(star):
+    if len(star) < 2:
+        return None
+    store = star[0].store
+    if isinstance(store, ShardedTripleStore):
+        return ShardedStar
+    if isinstance(store, IndexedTripleStore) and \
+       all(isinstance(p.pattern[1], LiteralExpression) for p in star):
+        return StarJoin
+    return None
+
+def _plan_stars(patterns):
+    planned = []
+    for run in _pattern_runs(patterns):
+        if not isinstance(run, list):
+            planned.append(run)
+            continue
+        stars = _subject_stars(run)
+        if not any(_star_operator(star) for star in stars):
+            planned.extend(run)
+            continue
+        for star in stars:
+            make = _star_operator(star)
+            if make is not None:
+                planned.append(make(star))
+            else:
+                planned.extend(star)
+    return planned
+
+def _has_range_index(store):
+    return getattr(store, '_ranges', None) is not None
+
+def _has_text_index(store):
+    return getattr(store, '_text', None) is not None
+
+def _plan_filters(patterns):
+    for i, f in enumerate(patterns):
+        if not isinstance(f, Filter):
+            continue
+        bounds = {}
+        _range_bounds(f.expression, bounds)
+        searches = {}
+        _text_searches(f.expression, searches)
+        for j in range(i):
+            p = patterns[j]
+            planned = None
+            for name, (low, high) in bounds.items():
+                if _binds_object(p, name) and _has_range_index(p.store):
+                    planned = RangePattern(p, low, high)
+            for name, search in searches.items():
+                if _binds_object(p, name) and _has_text_index(p.store):
+                    planned = TextPattern(p, search)
+            if planned is not None:
+                patterns[j] = planned
+                _move_to_front_of_run(patterns, j)
+    return patterns
+
+def _contains_filter(pattern):
+    if isinstance(pattern, Filter):
+        return True
+    if isinstance(pattern, PatternGroup):
+        return any(_contains_filter(p) for p in pattern.patterns)
+    if isinstance(pattern, OptionalGroup):
+        return _contains_filter(pattern.pattern)
+    if isinstance(pattern, UnionGroup):
+        return any(_contains_filter(p) for p in pattern.patterns)
+    if isinstance(pattern, GraphGroup):
+        return _contains_filter(pattern.pattern)
+    return False
+
+def _move_to_front_of_run(patterns, j):
+    # plain patterns next to each other are just joined, so they can be
+    # run in any order; start with the range scan unless an earlier
+    # pattern has a constant subject or object and so is likely smaller
+    start = j
+    while start > 0 and isinstance(patterns[start - 1], Pattern):
+        start -= 1
+        s, _, o = patterns[start].pattern
+        if isinstance(s, LiteralExpression) or isinstance(o, LiteralExpression):
+            return
+    patterns.insert(start, patterns.pop(j))
+
+class PatternGroup(object):
+    __slots__ = ('patterns', 'variables')
+    
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
         variables = []
         for p in self.patterns:
             variables.extend(p.variables)
-        return variables
+        self.variables = tuple(variables)
     
     def match(self, solution=None):
         joined = None
+        # the number of solutions expected so far, while it can be told,
+        # and the variables they bind
+        estimate = None
+        bound = set(solution.keys()) if solution is not None else set()
         for pattern in self.patterns:
             if joined is None:
                 joined = pattern.match(solution)
+                estimate = _estimate(pattern, bound)
+            elif isinstance(pattern, OptionalGroup) and pattern.batched:
+                joined = pattern.join(joined)
+                estimate = None
             else:
-                joined = self._join(joined, pattern)
-        for m in joined:
-            yield m
+                joined = self._join(joined, pattern, solution, estimate)
+                fanout = _estimate(pattern, bound)
+                if estimate is not None and fanout is not None:
+                    estimate *= fanout
+                else:
+                    estimate = None
+            bound.update(v.name for v in pattern.variables)
+        return joined
+    
+    def plan(self):
+        patterns = _plan_views(self._plan_patterns())
+        return PatternGroup(_plan_stars(_plan_cycles(_plan_filters(patterns))))
+    
+    def _plan_patterns(self):
+        patterns = []
+        for p in self.patterns:
+            # a group inside a group is joined just the same as if its
+            # patterns were inline, so flatten it to plan them together
+            if isinstance(p, PatternGroup):
+                patterns.extend(p._plan_patterns())
+            else:
+                patterns.append(p.plan())
+        return patterns
     
-    def _join(self, matches, pattern):
+    def _join(self, matches, pattern, solution, estimate):
+        guard = _current_guard()
+        switch = _switch_point(pattern, estimate)
+        probes = 0
         for m in matches:
             for m2 in pattern.match(m):
+                if guard is not None:
+                    guard.add_row()
                 yield m2
+            probes += 1
+            # far more solutions than expected have come, so go on by
+            # hashing the matches of the pattern rather than looking it
+            # up for each of the rest
+            if switch is not None and probes > switch:
+                for m2 in _hash_join(matches, pattern, solution):
+                    yield m2
+                return
     
     def __repr__(self):
-        return 'PatternGroup(%r)' % self.patterns
+        return 'PatternGroup(%r)' % list(self.patterns)
+
+
+def _estimate(pattern, bound):
+    # the matches expected for each solution fed to a pattern, or None
+    # if the store can't tell
+    if type(pattern) is not Pattern:
+        return None
+    return pattern.store._estimate(pattern.pattern, bound)
+
+def _switch_point(pattern, estimate):
+    # the number of solutions fed to a join after which it switches to
+    # a hash join, or None to stay with looking up each one
+    if estimate is None or type(pattern) is not Pattern:
+        return None
+    # the matches of a pattern repeating a variable are only filtered
+    # down to those agreeing on it when it is already bound
+    names = [v.name for v in pattern.variables]
+    if len(set(names)) < len(names):
+        return None
+    store = pattern.store
+    if store.ADAPTIVE_FACTOR is None:
+        return None
+    # the matches that would have to be hashed
+    build = store._estimate(pattern.pattern, ())
+    if build is None:
+        return None
+    return max(estimate * store.ADAPTIVE_FACTOR, build, store.ADAPTIVE_MIN_ROWS)
+
+def _hash_join(matches, pattern, solution):
+    guard = _current_guard()
+    names = tuple(_uniq(v.name for v in pattern.variables))
+    built = []
+    for m in pattern.match(solution):
+        if guard is not None:
+            guard.add_buffered(m)
+        built.append(tuple([m[name] for name in names]))
+    # a table for each set of the pattern's variables the solutions bind
+    tables = {}
+    for left in matches:
+        keys = tuple(i for i, name in enumerate(names) if name in left)
+        table = tables.get(keys)
+        if table is None:
+            table = tables[keys] = {}
+            for row in built:
+                table.setdefault(tuple([row[i] for i in keys]), []).append(row)
+        for row in table.get(tuple([left[names[i]] for i in keys]), ()):
+            m = left
+            for i, name in enumerate(names):
+                if i not in keys:
+                    m = Solution(m, name, row[i])
+            if guard is not None:
+                guard.add_row()
+            yield m
 
 
 class OptionalGroup(object):
+    __slots__ = ('pattern', 'variables', 'names', 'batched')
+    
+    BLOCK = 1000
+    
     def __init__(self, pattern):
         self.pattern = pattern
-    
-    @property
-    def variables(self):
-        return self.pattern.variables
+        self.variables = pattern.variables
+        self.names = tuple(_uniq(v.name for v in pattern.variables))
+        # a filter can refer to variables bound outside the pattern,
+        # so the pattern's own variables aren't enough to key on
+        self.batched = not _contains_filter(pattern)
     
     # just return untouched solution if nothing else matched
     def match(self, solution):
@@ -265,45 +1352,341 @@ class OptionalGroup(object):
         if not matched:
             yield solution
     
+    def join(self, matches):
+        guard = _current_guard()
+        while True:
+            block = list(islice(matches, self.BLOCK))
+            if not block:
+                return
+            extensions = {}
+            for left in block:
+                key = tuple([left.get(name) for name in self.names])
+                try:
+                    extended = extensions[key]
+                except KeyError:
+                    extended = extensions[key] = self._probe(key)
+                for bindings in extended:
+                    m = left
+                    for name, value in bindings:
+                        m = Solution(m, name, value)
+                    if guard is not None:
+                        guard.add_row()
+                    yield m
+                if not extended:
+                    if guard is not None:
+                        guard.add_row()
+                    yield left
+    
+    def _probe(self, key):
+        # the bindings each match adds to a solution with the given key
+        probe = Solution()
+        unbound = []
+        for name, value in zip(self.names, key):
+            if value is None:
+                unbound.append(name)
+            else:
+                probe = Solution(probe, name, value)
+        extended = []
+        for m in self.pattern.match(probe):
+            extended.append([(name, m[name]) for name in unbound if name in m])
+        return extended
+    
+    def plan(self):
+        return OptionalGroup(self.pattern.plan())
+    
     def __repr__(self):
         return 'OptionalGroup(%r)' % self.pattern
 
 class UnionGroup(object):
-    def __init__(self, pattern1, pattern2):
-        self.pattern1 = pattern1
-        self.pattern2 = pattern2
+    __slots__ = ('patterns', 'variables')
     
-    @property
-    def variables(self):
+    def __init__(self, *patterns):
+        self.patterns = patterns
         variables = []
-        variables.extend(self.pattern1.variables)
-        variables.extend(self.pattern2.variables)
-        return variables
+        for p in patterns:
+            variables.extend(p.variables)
+        self.variables = tuple(variables)
     
     def match(self, solution):
-        for m in self.pattern1.match(solution):
-            yield m
-        for m in self.pattern2.match(solution):
-            yield m
+        return chain.from_iterable(p.match(solution) for p in self.patterns)
+    
+    def plan(self):
+        # patterns that every branch starts with are matched once and
+        # each of their solutions fed to the rest of every branch
+        branches = [_flattened(p) for p in self.patterns]
+        shared = _shared_prefix(branches)
+        if not shared:
+            return UnionGroup(*[p.plan() for p in self.patterns])
+        rest = UnionGroup(*[PatternGroup(b[shared:]) for b in branches]).plan()
+        prefix = PatternGroup(branches[0][:shared]).plan()
+        return PatternGroup(prefix.patterns + (rest,))
     
     def __repr__(self):
-        return 'UnionGroup(%r, %r)' % (self.pattern1, self.pattern2)
+        return 'UnionGroup(%s)' % ', '.join(repr(p) for p in self.patterns)
+
+
+def _flattened(pattern):
+    if isinstance(pattern, PatternGroup):
+        return [q for p in pattern.patterns for q in _flattened(p)]
+    return [pattern]
+
+def _pattern_key(pattern):
+    if type(pattern) is not Pattern:
+        return None
+    key = [id(pattern.store)]
+    for e in pattern.pattern:
+        value = getattr(e, 'value', None)
+        key.append((type(e), getattr(e, 'name', None), type(value), value))
+    return tuple(key)
+
+def _shared_prefix(branches):
+    # the number of plain patterns at the start of every branch, leaving
+    # at least one pattern in each for the union
+    shared = max(min(len(b) for b in branches) - 1, 0)
+    for i in range(shared):
+        key = _pattern_key(branches[0][i])
+        if key is None or any(_pattern_key(b[i]) != key for b in branches[1:]):
+            return i
+    return shared
+
+class GraphGroup(object):
+    # matched in each named graph, with the graph variable bound to its name
+    __slots__ = ('store', 'graph', 'pattern', 'variables', 'plans')
+    
+    def __init__(self, store, graph, pattern):
+        self.store = store
+        self.graph = graph
+        self.pattern = pattern
+        variables = pattern.variables
+        if isinstance(graph, VariableExpression):
+            variables = (graph,) + variables
+        self.variables = variables
+        self.plans = {}
+    
+    def match(self, solution):
+        solution = _solution(solution)
+        name = self.graph.resolve(solution)
+        if name is not None:
+            names = (name,)
+            bind = None
+        else:
+            names = self.store._graph_names()
+            bind = self.graph.name
+        return chain.from_iterable(self._match_graph(name, bind, solution) for name in names)
+    
+    def _match_graph(self, name, bind, solution):
+        graph = self.store._graph(name)
+        if graph is None:
+            return ()
+        if bind is not None:
+            solution = Solution(solution, bind, name)
+        return self._plan_for(name, graph).match(solution)
+    
+    def _plan_for(self, name, graph):
+        planned = self.plans.get(name)
+        if planned is None or planned[0] is not graph:
+            planned = self.plans[name] = (graph, _rebind(self.pattern, self.store, graph).plan())
+        return planned[1]
+    
+    def plan(self):
+        return GraphGroup(self.store, self.graph, self.pattern)
+    
+    def __deepcopy__(self, memo):
+        # the plans made for each graph hold the terms of the original,
+        # so a copy makes its own
+        return GraphGroup(deepcopy(self.store, memo), deepcopy(self.graph, memo),
+                          deepcopy(self.pattern, memo))
+    
+    def __repr__(self):
+        return 'GraphGroup(%r, %r)' % (self.graph, self.pattern)
+
+
+class Dataset(object):
+    # matched against the merge of the graphs named by FROM clauses
+    __slots__ = ('graphs', 'pattern', 'variables')
+    
+    def __init__(self, graphs, pattern):
+        self.graphs = tuple(graphs)
+        self.pattern = pattern
+        self.variables = pattern.variables
+    
+    def __repr__(self):
+        return 'Dataset(%r, %r)' % (list(self.graphs), self.pattern)
+
+
+def _graph_groups(node):
+    if isinstance(node, GraphGroup):
+        yield node
+    elif isinstance(node, (tuple, list)):
+        for n in node:
+            for g in _graph_groups(n):
+                yield g
+    else:
+        for name in _slot_names(type(node)):
+            if name != 'store':
+                for g in _graph_groups(getattr(node, name)):
+                    yield g
+
+def _rebind(pattern, store, other):
+    memo = { id(store): other }
+    for group in _graph_groups(pattern):
+        memo[id(group)] = group
+    return deepcopy(pattern, memo)
+
+
+# the parts of operators worked out from the others, left out of the
+# shape of a query
+_DERIVED = frozenset(['store', 'variables', 'names', 'batched', 'key', 'plans'])
+
+def _slot_names(cls):
+    return [name for c in reversed(cls.__mro__) for name in c.__dict__.get('__slots__', ())]
+
+class _Terms(object):
+    def __init__(self, pinned=()):
+        self.pinned = pinned
+        self.names = []
+        self.values = []
+        self.variables = []
+        self.literals = []
+        self.paths = []
+        self._names = {}
+        self._values = {}
+    
+    def variable(self, v):
+        i = self._names.setdefault(v.name, len(self.names))
+        if i == len(self.names):
+            self.names.append(v.name)
+        self.variables.append((v, i))
+        return ('?', i)
+    
+    def literal(self, l):
+        value = (type(l.value), l.value)
+        i = self._values.setdefault(value, len(self.values))
+        if i == len(self.values):
+            self.values.append(value)
+        self.literals.append((l, i))
+        if value in self.pinned:
+            return ('=', i) + value
+        return ('$', i, value[0])
+
+_PATHS = (LinkPath, InversePath, SequencePath, AlternativePath, RepeatPath)
+
+def _shape(node, terms):
+    # the same for patterns differing only in their variable names
+    if isinstance(node, VariableExpression):
+        return terms.variable(node)
+    if isinstance(node, LiteralExpression):
+        return terms.literal(node)
+    if isinstance(node, (tuple, list)):
+        return tuple(_shape(n, terms) for n in node)
+    if isinstance(node, _PATHS):
+        terms.paths.append(node)
+    names = _slot_names(type(node))
+    if not names:
+        return node
+    start = len(terms.literals)
+    shape = (type(node),) + tuple(_shape(getattr(node, name), terms)
+                                  for name in names if name not in _DERIVED)
+    if isinstance(node, Filter):
+        # which of a filter's bounds is the tighter decides the range
+        # scanned, so keep the order of its literals
+        values = [terms.values[i][1] for l, i in terms.literals[start:]]
+        shape += (tuple(sorted(range(len(values)), key=values.__getitem__)),)
+    return shape
+
+def _view_constants(store):
+    views = getattr(store, '_views', None) or {}
+    return frozenset((type(e.value), e.value) for view in views.values()
+                     for p in view.patterns for e in p.pattern
+                     if isinstance(e, LiteralExpression))
+
+def _drifted(then, now, factor):
+    if then is None or now is None:
+        return False
+    return now > then * factor or then > now * factor
+
+class _PlanCache(object):
+    # plans keyed on the shape of their patterns
+    DRIFT = 2
+    
+    def __init__(self, size):
+        self.size = size
+        self._plans = {}
+    
+    def plan(self, store, patterns):
+        terms = _Terms(_view_constants(store))
+        key = _shape(patterns, terms)
+        size = store._size()
+        entry = self._plans.get(key)
+        if entry is not None and not _drifted(entry[4], size, self.DRIFT):
+            return self._instance(entry, terms)
+        planned = patterns.plan()
+        if len(self._plans) >= self.size:
+            self._plans.clear()
+        self._plans[key] = (planned, terms.variables, terms.literals, terms.paths, size)
+        return planned
+    
+    def _instance(self, entry, terms):
+        planned, variables, literals, paths, size = entry
+        memo = {}
+        renames = {}
+        for v, i in variables:
+            name = terms.names[i]
+            if v.name != name:
+                memo[id(v)] = VariableExpression(name)
+                renames[v.name] = name
+        for l, i in literals:
+            t, value = terms.values[i]
+            if type(l.value) is not t or l.value != value:
+                memo[id(l)] = LiteralExpression(value)
+        if not memo:
+            return planned
+        # paths hold no variables, so can be shared
+        for path in paths:
+            memo[id(path)] = path
+        planned = deepcopy(planned, memo)
+        if renames:
+            _rename(planned, renames, set())
+        return planned
+
+
+# the operators that keep the names of variables as well as the
+# VariableExpressions, and the slot they keep them in
+_NAMES = { OptionalGroup: 'names', TrieJoin: 'order' }
+
+def _rename(node, renames, seen):
+    if isinstance(node, (tuple, list)):
+        for n in node:
+            _rename(n, renames, seen)
+        return
+    if id(node) in seen:
+        return
+    seen.add(id(node))
+    slot = _NAMES.get(type(node))
+    if slot is not None:
+        setattr(node, slot, tuple(renames.get(n, n) for n in getattr(node, slot)))
+    for name in _slot_names(type(node)):
+        if name not in ('store', slot):
+            _rename(getattr(node, name), renames, seen)
 
 
 class Filter(object):
+    __slots__ = ('expression',)
+    
+    variables = ()
+    
     def __init__(self, expression):
         self.expression = expression
 
-    @property
-    def variables(self):
-        return []
-
     def match(self, solution):
         try:
             if self.expression.resolve(solution):
                 yield solution
         except TypeError:
             pass
+    
+    def plan(self):
+        return self
 
     def __repr__(self):
         return 'Filter(%r)' % (self.expression)
@@ -320,8 +1703,12 @@ def regex(s, pattern, flags=None):
     return re.search(pattern, s, f) is not None
 
 
+def contains(s, sub):
+    return sub in s
+
+
 class Expression(object):
-    pass
+    __slots__ = ()
 
 
 class FunctionCallExpression(Expression):
@@ -330,14 +1717,19 @@ class FunctionCallExpression(Expression):
         'isblank': lambda a: a == '',
         'str': unicode,
         'regex': regex,
+        'contains': contains,
     }
+    __slots__ = ('fn', 'args')
+    
     def __init__(self, fn, args):
-        self.fn = self.FUNCTIONS[(fn.lower())]
-        self.args = args
+        try:
+            self.fn = self.FUNCTIONS[(fn.lower())]
+        except KeyError:
+            raise ParseException(fn, 0, 'Unknown function %s' % fn)
+        self.args = tuple(args)
     
     def resolve(self, solution):
-        args = tuple(a.resolve(solution) for a in self.args)
-        return self.fn(*args)
+        return self.fn(*[a.resolve(solution) for a in self.args])
 
 
 class UnaryOperatorExpression(Expression):
@@ -345,13 +1737,14 @@ class UnaryOperatorExpression(Expression):
                   '-': operator.neg,
                   '+': operator.pos }
     
+    __slots__ = ('operator', 'rhs')
+    
     def __init__(self, op, rhs):
         self.operator = self.OPERATORS[op]
         self.rhs = rhs
     
     def resolve(self, solution):
-        a = self.rhs.resolve(solution)
-        return self.operator(a)
+        return self.operator(self.rhs.resolve(solution))
 
 
 class BinaryOperatorExpression(Expression):
@@ -363,21 +1756,23 @@ class BinaryOperatorExpression(Expression):
                      ('&&', lambda a,b: a and b),
                      ('||', lambda a,b: a or b)])
     
+    __slots__ = ('lhs', 'operator', 'rhs')
+    
     def __init__(self, lhs, op, rhs):    
         self.lhs = lhs
         self.operator = self.OPERATORS[op]
         self.rhs = rhs
 
     def resolve(self, solution):
-        a = self.lhs.resolve(solution)
-        b = self.rhs.resolve(solution)
-        return self.operator(a, b)
+        return self.operator(self.lhs.resolve(solution), self.rhs.resolve(solution))
 
     def __repr__(self):
         return u'(%s %s %s)' % (self.lhs, self.operator.__name__, self.rhs)
 
 
 class VariableExpression(Expression):
+    __slots__ = ('name',)
+    
     def __init__(self, name):
         self.name = name
     
@@ -395,6 +1790,8 @@ class VariableExpression(Expression):
 
 
 class LiteralExpression(Expression):
+    __slots__ = ('value',)
+    
     def __init__(self, value):
         self.value = value
     
@@ -406,6 +1803,8 @@ class LiteralExpression(Expression):
 
 
 class OrderBy(object):
+    __slots__ = ('expression', 'asc')
+    
     def __init__(self, expression, asc):
         self.expression = expression
         self.asc = asc
@@ -414,7 +1813,18 @@ class OrderBy(object):
         return self.expression.resolve(solution)
     
     def order(self, matches):
-        return sorted(matches, key=self._key, reverse=(not self.asc))
+        return sorted(_buffer(matches), key=self._key, reverse=(not self.asc))
+
+
+def _buffer(matches):
+    guard = _current_guard()
+    if guard is None:
+        return list(matches)
+    buffered = []
+    for m in matches:
+        guard.add_buffered(m)
+        buffered.append(m)
+    return buffered
 
 class Limit(object):
     def __init__(self, limit):
@@ -425,58 +1835,762 @@ class Offset(object):
         self.offset = int(offset)
 
 class Index(object):
-    
     def __init__(self, permutation):
         self.permutation = permutation
         self._index = {}
+        # the position in the key of each term of the triple
+        self._order = tuple(list(permutation).index(i) for i in (0, 1, 2))
     
     def _create_key(self, triple):
         return tuple(triple[i] for i in self.permutation)
     
+    def _triple(self, key):
+        a, b, c = self._order
+        return key[a], key[b], key[c]
+    
     def insert(self, triple):
         key = self._create_key(triple)
-        self._insert(self._index, key, triple)
+        self._insert(self._index, key)
     
-    def _insert(self, index, key, triple):
+    def _insert(self, index, key):
         if len(key) == 1:
-            index[key[0]] = triple
+            index[key[0]] = index.get(key[0], 0) + 1
         else:
             try:
                 subindex = index[key[0]]
             except KeyError:
                 subindex = {}
                 index[key[0]] = subindex
-            self._insert(subindex, key[1:], triple)
+            self._insert(subindex, key[1:])
     
     def match(self, triple):
         key = self._create_key(triple)
-        return self._match(self._index, key)
+        return self._match(self._index, key, ())
+    
+    def remove(self, triple):
+        self._remove(self._index, self._create_key(triple))
+    
+    def _remove(self, index, key):
+        if len(key) == 1:
+            count = index[key[0]] - 1
+            if count:
+                index[key[0]] = count
+            else:
+                del index[key[0]]
+        else:
+            subindex = index[key[0]]
+            self._remove(subindex, key[1:])
+            if not subindex:
+                del index[key[0]]
+    
+    def lookup(self, key):
+        index = self._index
+        for k in key:
+            index = index.get(k)
+            if index is None:
+                return None
+        return index
+    
+    def count(self, triple):
+        index = self._index
+        try:
+            for k in self._create_key(triple):
+                index = index[k]
+        except KeyError:
+            return 0
+        return index
+    
+    def contains(self, triple):
+        return self.count(triple) > 0
     
-    def _match_remaining(self, index, key):
+    def _match_remaining(self, index, key, prefix):
         if len(key):
-            if key[0] is not None:
+            if key[0] is not UNBOUND:
                 raise LookupError(key)
-            for v in index.values():
-                if getattr(v, 'values', None) is not None:
-                    for m in self._match_remaining(v, key[1:]):
-                        yield m
+            guard = _current_guard()
+            if len(key) == 1:
+                for k in index:
+                    if guard is not None:
+                        guard.check()
+                    yield self._triple(prefix + (k,))
+                return
+            for k, v in index.iteritems():
+                if guard is not None:
+                    guard.check()
+                for m in self._match_remaining(v, key[1:], prefix + (k,)):
+                    yield m
+    
+    def _match(self, index, key, prefix):
+        if key[0] is UNBOUND:
+            for m in self._match_remaining(index, key, prefix):
+                yield m
+        elif len(key) == 1:
+            if key[0] in index:
+                yield self._triple(prefix + key)
+        else:
+            subindex = index.get(key[0])
+            if subindex is not None:
+                for m in self._match(subindex, key[1:], prefix + key[:1]):
+                    yield m
+
+
+class _RangeIndex(object):
+    # objects of one predicate in sorted order, with their subjects
+    
+    def __init__(self):
+        # queries on other threads can merge at the same time, and the
+        # sorted objects and subjects are replaced together
+        self._lock = threading.Lock()
+        self._added = []
+        self._removed = []
+        self._sorted = ([], [])
+    
+    def add(self, subject, obj):
+        with self._lock:
+            self._added.append((obj, subject))
+    
+    def remove(self, subject, obj):
+        with self._lock:
+            self._removed.append((obj, subject))
+    
+    def _merged(self):
+        with self._lock:
+            if self._added or self._removed:
+                objects, subjects = self._sorted
+                entries = zip(objects, subjects) + self._added
+                if self._removed:
+                    removed = {}
+                    for entry in self._removed:
+                        removed[entry] = removed.get(entry, 0) + 1
+                    kept = []
+                    for entry in entries:
+                        count = removed.get(entry)
+                        if count:
+                            removed[entry] = count - 1
+                        else:
+                            kept.append(entry)
+                    entries = kept
+                entries.sort()
+                self._sorted = ([o for o, _ in entries], [s for _, s in entries])
+                self._added = []
+                self._removed = []
+            return self._sorted
+    
+    def range(self, low, high):
+        objects, subjects = self._merged()
+        start, stop = 0, len(objects)
+        if low is not None:
+            value, inclusive = low
+            start = (inclusive and bisect_left or bisect_right)(objects, value)
+        if high is not None:
+            value, inclusive = high
+            stop = (inclusive and bisect_right or bisect_left)(objects, value)
+        for i in xrange(start, stop):
+            yield subjects[i], objects[i]
+
+
+class _TextIndex(object):
+    # maps each lower cased trigram to the strings it occurs in
+    GRAM = 3
+    
+    def __init__(self):
+        self._postings = {}
+        self._counts = {}
+    
+    def _grams(self, value):
+        value = value.lower()
+        return set(value[i:i + self.GRAM] for i in xrange(len(value) - self.GRAM + 1))
+    
+    def add(self, value):
+        # the same string can be the object of many triples, and is
+        # only dropped from the postings along with the last of them
+        count = self._counts.get(value, 0)
+        self._counts[value] = count + 1
+        if count:
+            return
+        postings = self._postings
+        for gram in self._grams(value):
+            try:
+                postings[gram].add(value)
+            except KeyError:
+                postings[gram] = set([value])
+    
+    def remove(self, value):
+        count = self._counts.pop(value) - 1
+        if count:
+            self._counts[value] = count
+            return
+        postings = self._postings
+        for gram in self._grams(value):
+            postings[gram].discard(value)
+            if not postings[gram]:
+                del postings[gram]
+    
+    def candidates(self, fragment):
+        if not isinstance(fragment, basestring):
+            return None
+        postings = [self._postings.get(gram, ()) for gram in self._grams(fragment)]
+        if not postings:
+            return None
+        postings.sort(key=len)
+        smallest, rest = postings[0], postings[1:]
+        return [v for v in smallest if all(v in p for p in rest)]
+
+
+class _View(object):
+    # rows of a basic graph pattern, kept up to date as triples change
+    
+    def __init__(self, store, name, patterns):
+        self.store = store
+        self.name = name
+        self.patterns = tuple(patterns)
+        self.names = tuple(_uniq(v.name for p in self.patterns for v in p.variables))
+        self.rows = set()
+        self._by_value = [{} for name in self.names]
+    
+    def rows_with(self, bound):
+        # the smallest set of rows that can hold the bound values
+        rows = self.rows
+        for i, value in bound:
+            candidates = self._by_value[i].get(value, ())
+            if len(candidates) < len(rows):
+                rows = candidates
+        return rows
+    
+    def rows_using(self, triples):
+        found = set()
+        for t in triples:
+            for i, p in enumerate(self.patterns):
+                solution = Solution()
+                for e, value in zip(p.pattern, t):
+                    bound = e.resolve(solution)
+                    if bound is None:
+                        solution = Solution(solution, e.name, value)
+                    elif bound != value:
+                        break
                 else:
-                    yield v
+                    rest = self.patterns[:i] + self.patterns[i + 1:]
+                    matches = PatternGroup(rest).match(solution) if rest else [solution]
+                    for m in matches:
+                        found.add(tuple([m[name] for name in self.names]))
+        return found
+    
+    def add(self, rows):
+        for row in rows:
+            if row not in self.rows:
+                self.rows.add(row)
+                for i, value in enumerate(row):
+                    self._by_value[i].setdefault(value, set()).add(row)
+    
+    def remove(self, rows):
+        for row in rows:
+            if row in self.rows:
+                self.rows.remove(row)
+                for i, value in enumerate(row):
+                    by_value = self._by_value[i]
+                    by_value[value].discard(row)
+                    if not by_value[value]:
+                        del by_value[value]
+    
+    def clear(self):
+        self.rows = set()
+        self._by_value = [{} for name in self.names]
+    
+    def __deepcopy__(self, memo):
+        return self
+
+
+class IRI(str):
+    def __repr__(self):
+        return '<%s>' % self
+
+
+class BlankNode(str):
+    def __repr__(self):
+        return str(self)
+
+
+class LangString(str):
+    def __new__(cls, value, lang):
+        s = str.__new__(cls, value)
+        s.lang = lang
+        return s
     
-    def _match(self, index, key):
-        if key[0] is None:
-            for m in self._match_remaining(index, key):
-                yield m
+    def __getnewargs__(self):
+        return (str(self), self.lang)
+    
+    def __eq__(self, other):
+        if not isinstance(other, basestring):
+            return NotImplemented
+        return getattr(other, 'lang', None) == self.lang and str.__eq__(self, other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((str(self), self.lang))
+    
+    def __repr__(self):
+        return '%s@%s' % (str.__repr__(self), self.lang)
+
+
+class TypedLiteral(str):
+    def __new__(cls, value, datatype):
+        s = str.__new__(cls, value)
+        s.datatype = datatype
+        return s
+    
+    def __getnewargs__(self):
+        return (str(self), self.datatype)
+    
+    def __eq__(self, other):
+        if not isinstance(other, basestring):
+            return NotImplemented
+        return getattr(other, 'datatype', None) == self.datatype and str.__eq__(self, other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((str(self), self.datatype))
+    
+    def __repr__(self):
+        return '%s^^<%s>' % (str.__repr__(self), self.datatype)
+
+
+_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+_XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+_DATATYPES = {}
+for _name in ('integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger',
+              'nonPositiveInteger', 'negativeInteger', 'positiveInteger', 'unsignedLong',
+              'unsignedInt', 'unsignedShort', 'unsignedByte'):
+    _DATATYPES[_XSD + _name] = int
+for _name in ('decimal', 'double', 'float'):
+    _DATATYPES[_XSD + _name] = float
+_DATATYPES[_XSD + 'boolean'] = lambda value: value.strip() in ('true', '1')
+_DATATYPES[_XSD + 'string'] = str
+
+_TURTLE_TOKEN = re.compile(r'''
+    (?P<space>(?:\s+|\#[^\n]*)+)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<long>"""(?:[^"\\]|\\.|"(?!""))*"{0,2}"""|\'\'\'(?:[^'\\]|\\.|'(?!\'\'))*'{0,2}\'\'\')
+  | (?P<string>"(?:[^"\\\n]|\\.)*"(?!")|'(?:[^'\\\n]|\\.)*'(?!'))
+  | (?P<lang>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*)
+  | (?P<datatype>\^\^)
+  | (?P<bnode>_:[\w-]+(?:\.[\w-]+)*)
+  | (?P<number>[-+]?(?:\d*\.\d+(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+|\d+))
+  | (?P<pname>(?:[A-Za-z][\w-]*(?:\.[\w-]+)*)?:(?:[\w-]+(?:\.[\w-]+)*)?)
+  | (?P<word>[A-Za-z]\w*)
+  | (?P<punct>[.;,\[\]()])
+''', re.X)
+
+_ESCAPE = re.compile(r'\\(?:u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8})|(.))', re.S)
+_ESCAPES = { 't': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f' }
+
+def _unescape(match):
+    code = match.group(1) or match.group(2)
+    if code:
+        return unichr(int(code, 16)).encode('utf-8')
+    c = match.group(3)
+    return _ESCAPES.get(c, c)
+
+
+def _open_data(source):
+    # a path, which may be gzipped, an open file or an iterable of lines
+    if isinstance(source, basestring):
+        if source == '-':
+            return sys.stdin
+        f = open(source, 'rb')
+        if f.read(2) == '\x1f\x8b':
+            import gzip
+            f.close()
+            return gzip.open(source, 'rb')
+        f.seek(0)
+        return f
+    return source
+
+def _excerpt(text, pos, message):
+    # the line an error is on, as a mapped file is too big to pass whole
+    if isinstance(text, basestring):
+        return text, pos, message
+    start = text.rfind('\n', 0, pos) + 1
+    end = text.find('\n', pos)
+    if end < 0:
+        end = len(text)
+    line = 1
+    for i in xrange(0, start, 1 << 20):
+        line += text[i:min(i + (1 << 20), start)].count('\n')
+    return text[start:end], pos - start, '%s on line %d' % (message, line)
+
+def _read_chunks(source, size):
+    read = getattr(source, 'read', None)
+    if read is None:
+        for line in source:
+            yield line
+        return
+    while True:
+        chunk = read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class TurtleParser(object):
+    # reads N-Triples or Turtle a chunk at a time
+    CHUNK = 1 << 16
+    NAMES = frozenset(['iri', 'pname', 'bnode', 'word'])
+    TERM_CACHE_SIZE = 100000
+    # no token's extent depends on more than this many following characters
+    MARGIN = 4
+    
+    def __init__(self, source):
+        import uuid
+        self.source = source
+        self.prefixes = {}
+        self.base = None
+        # blank node labels only mean something within one document
+        self._document = uuid.uuid4().hex[:12]
+        self._blank_nodes = 0
+        self._terms = {}
+    
+    def _tokens(self):
+        if isinstance(self.source, file):
+            import stat
+            info = os.fstat(self.source.fileno())
+            if stat.S_ISREG(info.st_mode) and info.st_size:
+                return self._mapped_tokens()
+        return self._read_tokens()
+    
+    def _mapped_tokens(self):
+        # tokenize straight from the file's pages; the text of a name is
+        # only copied out the first time it is seen
+        import mmap
+        mapping = mmap.mmap(self.source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            texts = {}
+            match = _TURTLE_TOKEN.match
+            pos = self.source.tell()
+            end = len(mapping)
+            while pos < end:
+                m = match(mapping, pos)
+                if m is None:
+                    raise ParseException(*_excerpt(mapping, pos, 'Unexpected input'))
+                kind = m.lastgroup
+                start, pos = m.span()
+                if kind == 'space':
+                    continue
+                if kind in self.NAMES:
+                    key = buffer(mapping, start, pos - start)
+                    text = texts.get(key)
+                    if text is None:
+                        if len(texts) >= self.TERM_CACHE_SIZE:
+                            texts.clear()
+                        text = texts[key] = m.group()
+                else:
+                    text = m.group()
+                yield kind, text, mapping, start
+        finally:
+            texts = None
+            mapping.close()
+    
+    def _read_tokens(self):
+        chunks = _read_chunks(self.source, self.CHUNK)
+        buf = ''
+        pos = 0
+        more = True
+        while True:
+            match = _TURTLE_TOKEN.match(buf, pos)
+            # a token close to the end of what has been read may go on
+            # in the next chunk, so read more before taking it
+            if more and (match is None or match.end() > len(buf) - self.MARGIN):
+                try:
+                    buf = buf[pos:] + next(chunks)
+                    pos = 0
+                except StopIteration:
+                    more = False
+                continue
+            if match is None:
+                if pos == len(buf):
+                    return
+                raise ParseException(buf, pos, 'Unexpected input')
+            pos = match.end()
+            kind = match.lastgroup
+            if kind != 'space':
+                yield kind, match.group(kind), buf, match.start()
+    
+    def triples(self):
+        self._lookahead = None
+        self._stream = self._tokens()
+        while self._peek() is not None:
+            kind, text = self._peek()[:2]
+            if kind == 'lang' and text in ('@prefix', '@base'):
+                self._next()
+                self._directive(text[1:])
+                self._expect('.')
+            elif kind == 'word' and text.upper() in ('PREFIX', 'BASE'):
+                self._next()
+                self._directive(text.lower())
+            else:
+                for t in self._statement():
+                    yield t
+    
+    def _peek(self):
+        if self._lookahead is None:
+            self._lookahead = next(self._stream, None)
+        return self._lookahead
+    
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ParseException('', 0, 'Unexpected end of input')
+        self._lookahead = None
+        return token
+    
+    def _error(self, token, message):
+        raise ParseException(*_excerpt(token[2], token[3], message))
+    
+    def _expect(self, punct):
+        token = self._next()
+        if token[:2] != ('punct', punct):
+            self._error(token, 'Expected "%s"' % punct)
+    
+    def _directive(self, name):
+        self._terms.clear()
+        if name == 'prefix':
+            token = self._next()
+            if token[0] != 'pname' or not token[1].endswith(':'):
+                self._error(token, 'Expected prefix name')
+            self.prefixes[token[1]] = self._iri(self._next())
         else:
+            self.base = self._iri(self._next())
+    
+    def _iri(self, token):
+        if token[0] != 'iri':
+            self._error(token, 'Expected IRI')
+        iri = token[1][1:-1]
+        if '\\' in iri:
+            iri = _ESCAPE.sub(_unescape, iri)
+        if self.base is not None and ':' not in iri:
+            import urlparse
+            iri = urlparse.urljoin(self.base, iri)
+        return IRI(iri)
+    
+    def _statement(self):
+        triples = []
+        subject = self._term(triples)
+        # a blank node with its own properties can stand alone
+        if self._peek() is None or self._peek()[:2] != ('punct', '.') or not triples:
+            self._predicate_objects(subject, triples)
+        self._expect('.')
+        return triples
+    
+    def _predicate_objects(self, subject, triples):
+        while True:
+            token = self._next()
+            if token[:2] == ('word', 'a'):
+                predicate = IRI(_RDF + 'type')
+            else:
+                self._lookahead = token
+                predicate = self._term(triples)
+            while True:
+                triples.append((subject, predicate, self._term(triples)))
+                if not self._at(','):
+                    break
+                self._next()
+            if not self._at(';'):
+                return
+            while self._at(';'):
+                self._next()
+            if self._peek() is None or self._peek()[0] == 'punct':
+                return
+    
+    def _at(self, punct):
+        token = self._peek()
+        return token is not None and token[:2] == ('punct', punct)
+    
+    def _blank_node(self):
+        # labels read from the document never contain a #
+        self._blank_nodes += 1
+        return BlankNode('_:%s#%d' % (self._document, self._blank_nodes))
+    
+    def _literal(self, kind, text, triples):
+        quote = 3 if kind == 'long' else 1
+        value = text[quote:-quote]
+        if '\\' in value:
+            value = _ESCAPE.sub(_unescape, value)
+        following = self._peek()
+        if following is not None and following[0] == 'lang':
+            self._next()
+            return LangString(value, following[1][1:])
+        if following is not None and following[0] == 'datatype':
+            self._next()
+            datatype = self._term(triples)
+            convert = _DATATYPES.get(datatype)
+            if convert is None:
+                return TypedLiteral(value, datatype)
             try:
-                if len(key) == 1:
-                    yield index[key[0]]
+                return convert(value)
+            except ValueError:
+                return TypedLiteral(value, datatype)
+        return value
+    
+    def _name(self, token):
+        kind, text = token[:2]
+        if kind == 'iri':
+            return self._iri(token)
+        if kind == 'pname':
+            prefix, local = text.split(':', 1)
+            iri = self.prefixes.get(prefix + ':')
+            if iri is None:
+                return text
+            return IRI(iri + local)
+        if kind == 'bnode':
+            return BlankNode('_:%s-%s' % (self._document, text[2:]))
+        if text in ('true', 'false'):
+            return text == 'true'
+        return text
+    
+    def _term(self, triples):
+        token = self._next()
+        kind, text = token[:2]
+        if kind in self.NAMES:
+            # the same names come up again and again, so make each once
+            term = self._terms.get(text)
+            if term is None:
+                if len(self._terms) >= self.TERM_CACHE_SIZE:
+                    self._terms.clear()
+                term = self._terms[text] = self._name(token)
+            return term
+        if kind == 'number':
+            if '.' in text or 'e' in text or 'E' in text:
+                return float(text)
+            return int(text)
+        if kind in ('string', 'long'):
+            return self._literal(kind, text, triples)
+        if text == '[':
+            node = self._blank_node()
+            if not self._at(']'):
+                self._predicate_objects(node, triples)
+            self._expect(']')
+            return node
+        if text == '(':
+            head = previous = None
+            while not self._at(')'):
+                node = self._blank_node()
+                triples.append((node, IRI(_RDF + 'first'), self._term(triples)))
+                if previous is None:
+                    head = node
                 else:
-                    subindex = index[key[0]]
-                    for m in self._match(subindex, key[1:]):
-                        yield m
-            except KeyError:
-                pass
+                    triples.append((previous, IRI(_RDF + 'rest'), node))
+                previous = node
+            self._next()
+            if previous is None:
+                return IRI(_RDF + 'nil')
+            triples.append((previous, IRI(_RDF + 'rest'), IRI(_RDF + 'nil')))
+            return head
+        self._error(token, 'Unexpected "%s"' % text)
+
+
+_RDFS = 'http://www.w3.org/2000/01/rdf-schema#'
+_TYPE = _RDF + 'type'
+_SUBCLASS = _RDFS + 'subClassOf'
+_SUBPROPERTY = _RDFS + 'subPropertyOf'
+_DOMAIN = _RDFS + 'domain'
+_RANGE = _RDFS + 'range'
+
+def _resource(value):
+    # only resources are given types, not numbers or tagged literals
+    return isinstance(value, basestring) and not isinstance(value, (LangString, TypedLiteral))
+
+def _rdfs_consequences(triple, store):
+    s, p, o = triple
+    for q in store._objects(p, _SUBPROPERTY):
+        yield s, q, o
+    for c in store._objects(p, _DOMAIN):
+        yield s, _TYPE, c
+    if _resource(o):
+        for c in store._objects(p, _RANGE):
+            yield o, _TYPE, c
+    if p == _TYPE:
+        for c in store._objects(o, _SUBCLASS):
+            yield s, _TYPE, c
+    elif p == _SUBCLASS:
+        for c in store._objects(o, _SUBCLASS):
+            yield s, _SUBCLASS, c
+        for c in store._subjects(_SUBCLASS, s):
+            yield c, _SUBCLASS, o
+        for x in store._subjects(_TYPE, s):
+            yield x, _TYPE, o
+    elif p == _SUBPROPERTY:
+        for q in store._objects(o, _SUBPROPERTY):
+            yield s, _SUBPROPERTY, q
+        for q in store._subjects(_SUBPROPERTY, s):
+            yield q, _SUBPROPERTY, o
+        for x, y in store._pairs(s):
+            yield x, o, y
+    elif p == _DOMAIN:
+        for x, y in store._pairs(s):
+            yield x, _TYPE, o
+    elif p == _RANGE:
+        for x, y in store._pairs(s):
+            if _resource(y):
+                yield y, _TYPE, o
+
+def _rdfs_derivable(triple, store):
+    # whether one of the rules derives the triple straight from others
+    s, p, o = triple
+    if any(o in store._objects(s, q) for q in store._subjects(_SUBPROPERTY, p)):
+        return True
+    if p == _TYPE:
+        return any(c in store._objects(s, _TYPE) for c in store._subjects(_SUBCLASS, o)) \
+            or any(store._objects(s, q) for q in store._subjects(_DOMAIN, o)) \
+            or any(store._subjects(q, s) for q in store._subjects(_RANGE, o))
+    if p in (_SUBCLASS, _SUBPROPERTY):
+        return any(o in store._objects(m, p) for m in store._objects(s, p))
+    return False
+
+
+class _Entailments(object):
+    # triples along with those the RDFS rules derive from them
+    
+    def __init__(self, asserted):
+        self.asserted = asserted
+        self.store = IndexedTripleStore()
+    
+    def _contains(self, triple):
+        return self.store._indexes[(0, 1, 2)].contains(triple)
+    
+    def add(self, triples):
+        self._chain([t for t in triples if not self._contains(t)])
+    
+    def _chain(self, delta):
+        while delta:
+            self.store.add_triples(*delta)
+            found = set()
+            for triple in delta:
+                for t in _rdfs_consequences(triple, self.store):
+                    if t not in found and not self._contains(t):
+                        found.add(t)
+            delta = list(found)
+    
+    def remove(self, triples):
+        asserted = self.asserted._indexes[(0, 1, 2)]
+        deleted = set(triples)
+        delta = list(deleted)
+        while delta:
+            found = set()
+            for triple in delta:
+                for t in _rdfs_consequences(triple, self.store):
+                    if t not in deleted and not asserted.contains(t) and self._contains(t):
+                        found.add(t)
+            deleted.update(found)
+            delta = list(found)
+        self.store.remove_triples(*deleted)
+        self._chain([t for t in deleted if _rdfs_derivable(t, self.store)])
+    
+    def clear(self):
+        self.store.clear_triples()
 
 
 class TripleStore(object):
@@ -486,31 +2600,87 @@ class TripleStore(object):
     
     def add_triples(self, *triples):
         self._triples.extend(triples)
+    
+    def remove_triples(self, *triples):
+        removed = set(triples)
+        self._triples = [t for t in self._triples if t not in removed]
+    
+    def triples(self):
+        return iter(self._triples)
 
     def clear_triples(self):
         self._triples = []
 
     def match_triples(self, pattern, existing=None):
-        if existing is None:
-            existing = {}
-        triple = tuple(a.resolve(existing) for a in pattern)
-        for a, b, c in self._triples:
-            if _matches(triple, (a, b, c)):
-                matches = _get_matches(pattern, (a, b, c))
-                matches.update(existing)
-                yield matches
+        existing = _solution(existing)
+        triple, mask = _resolve_pattern(pattern, existing)
+        slots = _unbound_slots(pattern, mask)
+        guard = _current_guard()
+        for t in self._triples:
+            if guard is not None:
+                guard.check()
+            if _matches(triple, t):
+                yield _bind(existing, slots, t)
+    
+    def _objects(self, subject, predicate):
+        pattern = (LiteralExpression(subject), LiteralExpression(predicate), VariableExpression('o'))
+        return [m['o'] for m in self.match_triples(pattern)]
+    
+    def _subjects(self, predicate, obj):
+        pattern = (VariableExpression('s'), LiteralExpression(predicate), LiteralExpression(obj))
+        return [m['s'] for m in self.match_triples(pattern)]
+    
+    def _pairs(self, predicate):
+        pattern = (VariableExpression('s'), LiteralExpression(predicate), VariableExpression('o'))
+        return ((m['s'], m['o']) for m in self.match_triples(pattern))
+    
+    def _nodes(self):
+        pattern = (VariableExpression('s'), VariableExpression('p'), VariableExpression('o'))
+        nodes = set()
+        for m in self.match_triples(pattern):
+            nodes.add(m['s'])
+            nodes.add(m['o'])
+        return nodes
+    
+    def _closure(self, path, node, step):
+        return path.reachable(self, node, step)
+    
+    def match_path(self, pattern, existing=None):
+        existing = _solution(existing)
+        s, path, o = pattern
+        subject = s.resolve(existing)
+        obj = o.resolve(existing)
+        if subject is not None:
+            for node in path.forward(self, subject):
+                if obj is None:
+                    yield Solution(existing, o.name, node)
+                elif node == obj:
+                    yield existing
+        elif obj is not None:
+            for node in path.backward(self, obj):
+                yield Solution(existing, s.name, node)
+        else:
+            for a, b in path.pairs(self):
+                if s.name != o.name:
+                    yield Solution(Solution(existing, s.name, a), o.name, b)
+                elif a == b:
+                    yield Solution(existing, s.name, a)
     
     def parse_query(self, q):
-        _qp = _query_parser(self)
-
-        return _qp.parseString(q)
+        return _parse_query(self, q)
 
-    def query(self, q):
+    def query(self, q, timeout=None, max_rows=None, max_memory=None, inferred=False):
+        if inferred:
+            return self._inferred().query(q, timeout, max_rows, max_memory)
         p = self.parse_query(q)
         q = p.query
         distinct = len(q[0]) == 1 and q[0][0].lower() == 'distinct'
         variables = q[1]
         patterns = q[2]
+        store = self
+        if isinstance(patterns, Dataset):
+            store = self._dataset(patterns.graphs)
+            patterns = _rebind(patterns.pattern, self, store)
         
         order_by = None
         limit = None
@@ -524,19 +2694,90 @@ class TripleStore(object):
             elif isinstance(modifier, Offset):
                 offset = modifier.offset
         
-        return SelectQuery(distinct, variables, patterns, order_by, limit, offset)
+        limits = QueryLimits(timeout, max_rows, max_memory)
+        return SelectQuery(distinct, variables, patterns, order_by, limit, offset, limits,
+                           store._plan(patterns))
     
-    def import_file(self, file):
-        triple = Group(_literal + _literal + _literal + Literal('.').suppress())
-        
-        for line in file:
-            tokens = triple.parseString(line)
-            self.add_triples(*[tuple(t) for t in tokens])
+    def add_quads(self, *quads):
+        raise ValueError('the store has no named graphs')
+    
+    def _graph(self, name):
+        # the store holding a named graph, or None if there is no such graph
+        return None
+    
+    def _graph_names(self):
+        return ()
+    
+    def _dataset(self, names):
+        # the merge of the named graphs, to run a query with FROM clauses on
+        return TripleStore()
+    
+    def _inferred(self):
+        raise ValueError('the store does not keep inferred triples')
+    
+    PLAN_CACHE_SIZE = 1000
+    _plan_cache = None
+    
+    def _plan(self, patterns):
+        if not self.PLAN_CACHE_SIZE:
+            return patterns.plan()
+        cache = self._plan_cache
+        if cache is None:
+            cache = self._plan_cache = _PlanCache(self.PLAN_CACHE_SIZE)
+        return cache.plan(self, patterns)
+    
+    def _size(self):
+        return len(self._triples)
+    
+    # a join switches to hashing the matches of its pattern once the
+    # solutions fed to it outnumber their estimate by ADAPTIVE_FACTOR
+    # (None never switches), the matches of the pattern and
+    # ADAPTIVE_MIN_ROWS
+    ADAPTIVE_FACTOR = 4
+    ADAPTIVE_MIN_ROWS = 1000
+    
+    def _estimate(self, pattern, bound):
+        return None
+    
+    def __deepcopy__(self, memo):
+        # plans are copied with their stores shared
+        return self
+    
+    IMPORT_BATCH = 10000
+    
+    def import_file(self, file, graph=None):
+        # a path (which may be gzipped), an open file or an iterable of lines
+        source = _open_data(file)
+        try:
+            triples = TurtleParser(source).triples()
+            while True:
+                batch = list(islice(triples, self.IMPORT_BATCH))
+                if not batch:
+                    break
+                if graph is None:
+                    self.add_triples(*batch)
+                else:
+                    self.add_quads(*[t + (graph,) for t in batch])
+        finally:
+            # only what was opened here is closed
+            if source is not file and source is not sys.stdin:
+                source.close()
 
 
 class IndexedTripleStore(TripleStore):
     
-    def __init__(self):
+    def __init__(self, text_index=False, path_cache_size=0, inference=False):
+        self._path_cache_size = path_cache_size
+        self._path_cache = {}
+        self._views = {}
+        self._graphs = {}
+        self._merges = {}
+        self._entailments = None
+        if inference:
+            self._entailments = _Entailments(self)
+        self._create_indexes(text_index)
+    
+    def _create_indexes(self, text_index):
         permutations = [(0, 1, 2), (0, 2, 1),
                         (1, 0, 2), (1, 2, 0),
                         (2, 1, 0), (2, 0, 1)]
@@ -547,53 +2788,1243 @@ class IndexedTripleStore(TripleStore):
             self._indexes[p[:2]] = index
             self._indexes[p[:1]] = index
             self._indexes[()] = index
+        # the index to match each shape of pattern with, one whose key
+        # starts with all of the bound positions
+        self._shapes = tuple(self._indexes[tuple(i for i in (0, 1, 2) if mask & (1 << i))]
+                             for mask in range(8))
+        self._ranges = {}
+        self._predicates = {}
+        self._count = 0
+        self._text = None
+        if text_index:
+            self._text = _TextIndex()
+        self._path_cache.clear()
+        for view in self._views.values():
+            view.clear()
     
     def add_triples(self, *triples):
+        spo = self._indexes[(0, 1, 2)]
+        triples = [t for t in _uniq(triples) if not spo.contains(t)]
+        if triples:
+            self._path_cache.clear()
+        self._count += len(triples)
         for index in set(self._indexes.values()):
             for triple in triples:
                 index.insert(triple)
+        predicates = self._predicates
+        for s, p, o in triples:
+            predicates[p] = predicates.get(p, 0) + 1
+            try:
+                ranges = self._ranges[p]
+            except KeyError:
+                ranges = self._ranges[p] = _RangeIndex()
+            ranges.add(s, o)
+            if self._text is not None and isinstance(o, basestring):
+                self._text.add(o)
+        for view in self._views.values():
+            view.add(view.rows_using(triples))
+        if self._entailments is not None:
+            self._entailments.add(triples)
+    
+    def remove_triples(self, *triples):
+        spo = self._indexes[(0, 1, 2)]
+        triples = [t for t in _uniq(triples) if spo.contains(t)]
+        if triples:
+            self._path_cache.clear()
+        # the rows to drop have to be found while the triples are there
+        dropped = [(view, view.rows_using(triples)) for view in self._views.values()]
+        for view, rows in dropped:
+            view.remove(rows)
+        self._count -= len(triples)
+        for index in set(self._indexes.values()):
+            for triple in triples:
+                index.remove(triple)
+        predicates = self._predicates
+        for s, p, o in triples:
+            if predicates[p] == 1:
+                del predicates[p]
+            else:
+                predicates[p] -= 1
+            self._ranges[p].remove(s, o)
+            if self._text is not None and isinstance(o, basestring):
+                self._text.remove(o)
+        if self._entailments is not None:
+            self._entailments.remove(triples)
     
-    def _find_index(self, pattern):
-        _key = tuple(i for (i,a) in enumerate(pattern) if a)
-        return self._indexes[_key]
+    def clear_triples(self):
+        self._create_indexes(self._text is not None)
+        self._graphs = {}
+        self._merges = {}
+        if self._entailments is not None:
+            self._entailments.clear()
+    
+    MERGES = 16
+    
+    def _graph_store(self):
+        return IndexedTripleStore(self._text is not None, self._path_cache_size)
+    
+    def add_quads(self, *quads):
+        for name, triples in _by_graph(quads):
+            if name is None:
+                IndexedTripleStore.add_triples(self, *triples)
+                continue
+            graph = self._graphs.get(name)
+            if graph is None:
+                graph = self._graphs[name] = self._graph_store()
+            spo = graph._indexes[(0, 1, 2)]
+            triples = [t for t in _uniq(triples) if not spo.contains(t)]
+            graph.add_triples(*triples)
+            for names, merged in self._merges.items():
+                if name in names:
+                    merged.add_triples(*triples)
+    
+    def remove_quads(self, *quads):
+        for name, triples in _by_graph(quads):
+            if name is None:
+                IndexedTripleStore.remove_triples(self, *triples)
+                continue
+            graph = self._graphs.get(name)
+            if graph is None:
+                continue
+            spo = graph._indexes[(0, 1, 2)]
+            triples = [t for t in _uniq(triples) if spo.contains(t)]
+            graph.remove_triples(*triples)
+            for names, merged in self._merges.items():
+                if name in names:
+                    merged.remove_triples(*triples)
+            if not graph._size():
+                del self._graphs[name]
+    
+    def drop_graph(self, name):
+        graph = self._graphs.pop(name, None)
+        if graph is not None:
+            triples = list(graph.triples())
+            for names, merged in self._merges.items():
+                if name in names:
+                    merged.remove_triples(*triples)
+    
+    def graphs(self):
+        return list(self._graphs)
+    
+    def quads(self):
+        for name, graph in self._graphs.items():
+            for s, p, o in graph.triples():
+                yield s, p, o, name
+    
+    def _graph(self, name):
+        return self._graphs.get(name)
+    
+    def _graph_names(self):
+        return list(self._graphs)
+    
+    def _dataset(self, names):
+        names = tuple(sorted(set(names)))
+        if len(names) == 1:
+            return self._graphs.get(names[0]) or self._graph_store()
+        merged = self._merges.get(names)
+        if merged is None:
+            if len(self._merges) >= self.MERGES:
+                self._merges.clear()
+            merged = _MergedGraph(self._text is not None, self._path_cache_size)
+            for name in names:
+                graph = self._graphs.get(name)
+                if graph is not None:
+                    merged.add_triples(*graph.triples())
+            self._merges[names] = merged
+        return merged
+    
+    def _inferred(self):
+        if self._entailments is None:
+            return TripleStore._inferred(self)
+        return self._entailments.store
+    
+    def triples(self):
+        return self._indexes[(0, 1, 2)].match((UNBOUND, UNBOUND, UNBOUND))
+    
+    def _size(self):
+        return self._count
+    
+    def _estimate(self, pattern, bound):
+        # taking the terms to be spread evenly, which they often aren't
+        s, p, o = pattern
+        if not isinstance(p, VariableExpression):
+            total = self._predicates.get(p.value, 0)
+            if not total:
+                return 0
+            subjects = len(self._indexes[(1, 0, 2)].lookup((p.value,)))
+            objects = len(self._indexes[(1, 2, 0)].lookup((p.value,)))
+        else:
+            total = self._count
+            if not total:
+                return 0
+            subjects = len(self._indexes[(0, 1, 2)].lookup(()))
+            objects = len(self._indexes[(2, 0, 1)].lookup(()))
+            if p.name in bound:
+                total /= float(len(self._indexes[(1, 0, 2)].lookup(())))
+        if not isinstance(s, VariableExpression) or s.name in bound:
+            total /= float(subjects)
+        if not isinstance(o, VariableExpression) or o.name in bound:
+            total /= float(objects)
+        return total
+    
+    def materialize(self, name, q):
+        patterns = _flattened(self.parse_query(q).query[2])
+        if not patterns or not all(type(p) is Pattern for p in patterns):
+            raise ValueError('only triple patterns can be materialized')
+        view = _View(self, name, patterns)
+        view.add(tuple([m[n] for n in view.names]) for m in PatternGroup(patterns).match(Solution()))
+        self._views[name] = view
+        self._plan_cache = None
+    
+    def drop_view(self, name):
+        del self._views[name]
+        self._plan_cache = None
     
     def match_triples(self, pattern, existing=None):
-        if existing is None:
-            existing = {}
-        triple = tuple(a.resolve(existing) for a in pattern)
-        index = self._find_index(triple)
-        for m in index.match(triple):
-            matches = _get_matches(pattern, m)
-            matches.update(existing)
-            yield matches
+        existing = _solution(existing)
+        triple, mask = _resolve_pattern(pattern, existing)
+        slots = _unbound_slots(pattern, mask)
+        for m in self._shapes[mask].match(triple):
+            yield _bind(existing, slots, m)
+    
+    def match_range(self, pattern, low, high, existing=None):
+        existing = _solution(existing)
+        s, p, o = pattern
+        ranges = self._ranges.get(p.resolve(existing))
+        if ranges is None:
+            return
+        guard = _current_guard()
+        for subject, obj in ranges.range(low, high):
+            if guard is not None:
+                guard.check()
+            yield Solution(Solution(existing, s.name, subject), o.name, obj)
+    
+    def _star_subjects(self, predicate, obj):
+        # the subjects having a predicate (and object, if it is known)
+        if obj is None:
+            return self._indexes[(1, 0, 2)].lookup((predicate,))
+        return self._indexes[(1, 2, 0)].lookup((predicate, obj))
+    
+    def _objects(self, subject, predicate):
+        return self._indexes[(0, 1, 2)].lookup((subject, predicate)) or ()
+    
+    def _subjects(self, predicate, obj):
+        return self._indexes[(1, 2, 0)].lookup((predicate, obj)) or ()
+    
+    def _pairs(self, predicate):
+        for s, objects in (self._indexes[(1, 0, 2)].lookup((predicate,)) or {}).iteritems():
+            for o in objects:
+                yield s, o
+    
+    def _nodes(self):
+        nodes = set(self._indexes[(0, 1, 2)].lookup(()))
+        nodes.update(self._indexes[(2, 0, 1)].lookup(()))
+        return nodes
+    
+    def _closure(self, path, node, step):
+        if not self._path_cache_size:
+            return path.reachable(self, node, step)
+        key = (path.key, step.__name__, node)
+        try:
+            return self._path_cache[key]
+        except KeyError:
+            pass
+        if len(self._path_cache) >= self._path_cache_size:
+            self._path_cache.clear()
+        nodes = self._path_cache[key] = tuple(path.reachable(self, node, step))
+        return nodes
+    
+    def match_join(self, patterns, order, existing=None):
+        existing = _solution(existing)
+        patterns = [tuple([e if isinstance(e, VariableExpression) and e.resolve(existing) is None
+                           else e.resolve(existing) for e in p]) for p in patterns]
+        # a pattern bound all through by the solution is only checked
+        spo = self._indexes[(0, 1, 2)]
+        for p in patterns:
+            if not any(isinstance(e, VariableExpression) for e in p) and not spo.contains(p):
+                return iter(())
+        order = [name for name in order if existing.get(name) is None]
+        # for each variable, the patterns it is in and which of their
+        # positions are known by the time it is reached
+        steps = []
+        known = set()
+        for name in order:
+            lookups = []
+            for p in patterns:
+                positions = [i for i, e in enumerate(p) if isinstance(e, VariableExpression) and e.name == name]
+                if positions:
+                    bound = [i for i, e in enumerate(p) if not isinstance(e, VariableExpression) or e.name in known]
+                    index = self._indexes[tuple(bound) + (positions[0],)]
+                    lookups.append((index, [p[i] for i in bound]))
+            steps.append((name, lookups))
+            known.add(name)
+        return self._join_steps(steps, existing, _current_guard())
+    
+    def _join_steps(self, steps, solution, guard):
+        if not steps:
+            yield solution
+            return
+        (name, lookups), rest = steps[0], steps[1:]
+        candidates = []
+        for index, key in lookups:
+            values = index.lookup([e.resolve(solution) if isinstance(e, VariableExpression) else e
+                                   for e in key])
+            if not values:
+                return
+            candidates.append(values)
+        candidates.sort(key=len)
+        smallest, others = candidates[0], candidates[1:]
+        for value in smallest:
+            if guard is not None:
+                guard.check()
+            if all(value in c for c in others):
+                for m in self._join_steps(rest, Solution(solution, name, value), guard):
+                    yield m
+    
+    def match_star(self, subject, patterns, existing=None):
+        existing = _solution(existing)
+        patterns = [(p.resolve(existing), o) for p, o in patterns]
+        s = subject.resolve(existing)
+        if s is None:
+            # drive from the pattern with the fewest subjects
+            subjects = None
+            for p, o in patterns:
+                candidates = self._star_subjects(p, o.resolve(existing))
+                if not candidates:
+                    return
+                if subjects is None or len(candidates) < len(subjects):
+                    subjects = candidates
+            bind = subject.name
+        else:
+            subjects = (s,)
+            bind = None
+        spo = self._indexes[(0, 1, 2)]._index
+        guard = _current_guard()
+        for s in subjects:
+            if guard is not None:
+                guard.check()
+            predicates = spo.get(s)
+            if predicates is None:
+                continue
+            rows = [existing if bind is None else Solution(existing, bind, s)]
+            for p, o in patterns:
+                objects = predicates.get(p)
+                if objects is None:
+                    rows = None
+                    break
+                extended = []
+                for row in rows:
+                    value = o.resolve(row)
+                    if value is None:
+                        extended.extend([Solution(row, o.name, v) for v in objects])
+                    elif value in objects:
+                        extended.append(row)
+                rows = extended
+                if not rows:
+                    break
+            if rows:
+                for row in rows:
+                    yield row
+    
+    def match_text(self, pattern, fragment, test, existing=None):
+        existing = _solution(existing)
+        s, p, o = pattern
+        candidates = self._text.candidates(fragment)
+        if candidates is None:
+            for m in self.match_triples(pattern, existing):
+                yield m
+            return
+        predicate = p.resolve(existing)
+        index = self._indexes[(1, 2)]
+        guard = _current_guard()
+        for value in candidates:
+            if guard is not None:
+                guard.check()
+            if test(value):
+                for t in index.match((UNBOUND, predicate, value)):
+                    yield Solution(Solution(existing, s.name, t[0]), o.name, value)
+
+
+def _by_graph(quads):
+    graphs = {}
+    for s, p, o, g in quads:
+        graphs.setdefault(g, []).append((s, p, o))
+    return graphs.items()
+
+
+class _MergedGraph(IndexedTripleStore):
+    # the merge of the graphs named by more than one FROM clause
+    
+    def add_triples(self, *triples):
+        spo = self._indexes[(0, 1, 2)]
+        indexes = set(self._indexes.values())
+        fresh = []
+        for t in triples:
+            if spo.contains(t):
+                for index in indexes:
+                    index.insert(t)
+            else:
+                fresh.append(t)
+        IndexedTripleStore.add_triples(self, *fresh)
+    
+    def remove_triples(self, *triples):
+        spo = self._indexes[(0, 1, 2)]
+        indexes = set(self._indexes.values())
+        gone = []
+        for t in triples:
+            if spo.count(t) > 1:
+                for index in indexes:
+                    index.remove(t)
+            else:
+                gone.append(t)
+        IndexedTripleStore.remove_triples(self, *gone)
+
+
+class ShardedTripleStore(TripleStore):
+    # triples spread over stores by a hash of their subject
+    
+    def __init__(self, shards=4, store_factory=IndexedTripleStore):
+        self.shards = tuple(store_factory() for i in range(shards))
+    
+    def _shard_number(self, subject):
+        # hash() so that equal values, such as 1 and 1.0, go to the same shard
+        return hash(subject) % len(self.shards)
+    
+    def _partition(self, triples):
+        partitions = [[] for shard in self.shards]
+        for triple in triples:
+            partitions[self._shard_number(triple[0])].append(triple)
+        return zip(self.shards, partitions)
+    
+    def add_triples(self, *triples):
+        for shard, partition in self._partition(triples):
+            if partition:
+                shard.add_triples(*partition)
+    
+    def remove_triples(self, *triples):
+        for shard, partition in self._partition(triples):
+            if partition:
+                shard.remove_triples(*partition)
+    
+    def clear_triples(self):
+        for shard in self.shards:
+            shard.clear_triples()
+    
+    def triples(self):
+        return chain.from_iterable(shard.triples() for shard in self.shards)
+    
+    def _size(self):
+        return sum(shard._size() for shard in self.shards)
+    
+    def match_triples(self, pattern, existing=None):
+        existing = _solution(existing)
+        subject = pattern[0].resolve(existing)
+        if subject is not None:
+            return self.shards[self._shard_number(subject)].match_triples(pattern, existing)
+        return chain.from_iterable(shard.match_triples(pattern, existing)
+                                   for shard in self.shards)
+
+
+class TripleLog(object):
+    # an append-only file of batches of changes
+    
+    def __init__(self, path, group_size=1000):
+        self.path = path
+        self.group_size = group_size
+        self._pending = []
+        self._pending_size = 0
+        self._file = None
+    
+    def replay(self):
+        import cPickle
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            end = 0
+            while True:
+                try:
+                    op, triples = cPickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # a batch that was only partly written when we went
+                    # down never got committed, so it is dropped
+                    break
+                end = f.tell()
+                yield op, triples
+        if end != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+    
+    def append(self, op, triples):
+        import cPickle
+        self._pending.append(cPickle.dumps((op, triples), cPickle.HIGHEST_PROTOCOL))
+        self._pending_size += len(triples) or 1
+        if self._pending_size >= self.group_size:
+            self.commit()
+    
+    def commit(self):
+        if not self._pending:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._file.write(''.join(self._pending))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = []
+        self._pending_size = 0
+    
+    def truncate(self):
+        self._pending = []
+        self._pending_size = 0
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'wb')
+        os.fsync(self._file.fileno())
+    
+    def close(self):
+        self.commit()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PersistentTripleStore(IndexedTripleStore):
+    SNAPSHOT = 'snapshot'
+    LOG = 'log'
+    BATCH = 10000
+    
+    def __init__(self, directory, group_size=1000, text_index=False):
+        IndexedTripleStore.__init__(self, text_index)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load_snapshot()
+        self._log = TripleLog(os.path.join(directory, self.LOG), group_size)
+        apply = { '+': IndexedTripleStore.add_triples,
+                  '-': IndexedTripleStore.remove_triples,
+                  '+quads': IndexedTripleStore.add_quads,
+                  '-quads': IndexedTripleStore.remove_quads,
+                  'drop': IndexedTripleStore.drop_graph,
+                  'clear': lambda self: IndexedTripleStore.clear_triples(self) }
+        for op, triples in self._log.replay():
+            apply[op](self, *triples)
+    
+    def _load_snapshot(self):
+        import cPickle
+        path = os.path.join(self.directory, self.SNAPSHOT)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    triples = cPickle.load(f)
+                except EOFError:
+                    break
+                if len(triples[0]) == 4:
+                    IndexedTripleStore.add_quads(self, *triples)
+                else:
+                    IndexedTripleStore.add_triples(self, *triples)
+    
+    def add_triples(self, *triples):
+        IndexedTripleStore.add_triples(self, *triples)
+        self._log.append('+', triples)
+    
+    def remove_triples(self, *triples):
+        IndexedTripleStore.remove_triples(self, *triples)
+        self._log.append('-', triples)
+    
+    def add_quads(self, *quads):
+        IndexedTripleStore.add_quads(self, *quads)
+        self._log.append('+quads', quads)
+    
+    def remove_quads(self, *quads):
+        IndexedTripleStore.remove_quads(self, *quads)
+        self._log.append('-quads', quads)
+    
+    def drop_graph(self, name):
+        IndexedTripleStore.drop_graph(self, name)
+        self._log.append('drop', (name,))
+    
+    def clear_triples(self):
+        IndexedTripleStore.clear_triples(self)
+        self._log.append('clear', ())
+    
+    def commit(self):
+        self._log.commit()
+    
+    def compact(self):
+        import cPickle
+        path = os.path.join(self.directory, self.SNAPSHOT)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for triples in (self.triples(), self.quads()):
+                while True:
+                    batch = list(islice(triples, self.BATCH))
+                    if not batch:
+                        break
+                    cPickle.dump(batch, f, cPickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        # replaying the old log over the new snapshot would do no harm,
+        # as adds and removes of whole triples can be repeated safely,
+        # so going down before this point loses nothing
+        self._log.truncate()
+    
+    def close(self):
+        self._log.close()
+
+
+class DiskTripleStore(TripleStore):
+    # triples kept in a sqlite database instead of in memory
+    
+    KINDS = ((bool, 3), (int, 1), (long, 1), (float, 2))
+    
+    def __init__(self, path, cache_size=2000, term_cache_size=100000):
+        self.path = path
+        self.cache_size = cache_size
+        self.term_cache_size = term_cache_size
+        self._connect()
+    
+    def _connect(self):
+        import sqlite3
+        # the connection is shared by the threads of the HTTP server, so
+        # it is only used while holding the lock
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        # strings go in as utf-8 and come back out as it, like the
+        # terms of the other stores
+        self._db.text_factory = str
+        self._db.execute('PRAGMA cache_size = %d' % int(self.cache_size))
+        # readers aren't blocked by a writer, and commits need fewer syncs
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY,
+                                              kind INTEGER NOT NULL,
+                                              value NOT NULL);
+            CREATE UNIQUE INDEX IF NOT EXISTS terms_value ON terms (value, kind);
+            CREATE TABLE IF NOT EXISTS triples (s INTEGER NOT NULL,
+                                                p INTEGER NOT NULL,
+                                                o INTEGER NOT NULL,
+                                                PRIMARY KEY (s, p, o)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s);
+            CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p);
+        ''')
+        self._ids = {}
+        self._terms = {}
+    
+    def reconnect(self):
+        # a connection can't be shared with a forked process
+        self._connect()
+    
+    def _size(self):
+        # counting the rows is a scan, so plans are kept however it grows
+        return None
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+    
+    def _encode(self, term):
+        for t, kind in self.KINDS:
+            if isinstance(term, t):
+                return kind, term
+        # the tag or datatype goes in front, as neither has a space or @
+        if isinstance(term, LangString):
+            return 4, ('%s@%s' % (term.lang, term)).decode('utf-8')
+        if isinstance(term, TypedLiteral):
+            return 5, ('%s %s' % (term.datatype, term)).decode('utf-8')
+        if isinstance(term, str):
+            term = term.decode('utf-8')
+        return 0, term
+    
+    def _decode(self, kind, value):
+        if kind == 3:
+            return bool(value)
+        if kind == 4:
+            lang, value = value.split('@', 1)
+            return LangString(value, lang)
+        if kind == 5:
+            datatype, value = value.split(' ', 1)
+            return TypedLiteral(value, datatype)
+        return value
+    
+    def _cache(self, term, id):
+        # a crude bound on the memory used: forget everything once full
+        if len(self._ids) >= self.term_cache_size:
+            self._ids = {}
+            self._terms = {}
+        self._ids[(type(term), term)] = id
+        self._terms[id] = term
+    
+    def _term_id(self, term, create=False):
+        key = (type(term), term)
+        try:
+            return self._ids[key]
+        except KeyError:
+            pass
+        kind, value = self._encode(term)
+        with self._lock:
+            row = self._db.execute('SELECT id FROM terms WHERE value = ? AND kind = ?',
+                                   (value, kind)).fetchone()
+            if row is not None:
+                id = row[0]
+            elif create:
+                id = self._db.execute('INSERT INTO terms (kind, value) VALUES (?, ?)',
+                                      (kind, value)).lastrowid
+            else:
+                return None
+        self._cache(term, id)
+        return id
+    
+    def _lookup_terms(self, ids):
+        terms = {}
+        missing = []
+        for id in set(ids):
+            term = self._terms.get(id, _missing)
+            if term is _missing:
+                missing.append(id)
+            else:
+                terms[id] = term
+        for i in xrange(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            with self._lock:
+                rows = self._db.execute('SELECT id, kind, value FROM terms WHERE id IN (%s)'
+                                        % ','.join('?' * len(chunk)), chunk).fetchall()
+            for id, kind, value in rows:
+                term = terms[id] = self._decode(kind, value)
+                self._cache(term, id)
+        return [terms[id] for id in ids]
+    
+    def add_triples(self, *triples):
+        with self._lock, self._db:
+            rows = [tuple(self._term_id(t, True) for t in triple) for triple in triples]
+            self._db.executemany('INSERT OR IGNORE INTO triples (s, p, o) VALUES (?, ?, ?)', rows)
+    
+    def remove_triples(self, *triples):
+        with self._lock, self._db:
+            rows = []
+            for triple in triples:
+                row = tuple(self._term_id(t) for t in triple)
+                if None not in row:
+                    rows.append(row)
+            self._db.executemany('DELETE FROM triples WHERE s = ? AND p = ? AND o = ?', rows)
+    
+    def clear_triples(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM triples')
+            self._db.execute('DELETE FROM terms')
+        self._ids = {}
+        self._terms = {}
+    
+    def match_triples(self, pattern, existing=None):
+        existing = _solution(existing)
+        triple, mask = _resolve_pattern(pattern, existing)
+        slots = _unbound_slots(pattern, mask)
+        where = []
+        params = []
+        for column, term in zip('spo', triple):
+            if term is not UNBOUND:
+                id = self._term_id(term)
+                if id is None:
+                    return
+                where.append('%s = ?' % column)
+                params.append(id)
+        sql = 'SELECT s, p, o FROM triples'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        for triple in self._select(sql, params):
+            yield _bind(existing, slots, triple)
+    
+    def triples(self):
+        return self._select('SELECT s, p, o FROM triples', ())
+    
+    def _select(self, sql, params):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+        guard = _current_guard()
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                break
+            if guard is not None:
+                guard.check()
+            terms = self._lookup_terms([id for row in rows for id in row])
+            for i in xrange(0, len(terms), 3):
+                yield tuple(terms[i:i + 3])
 
 
 def _matches(pattern, triple):
     for p, t in zip(pattern, triple):
-        if not(p is None or p == t):
+        if not(p is UNBOUND or p == t):
             return False
     return True
 
 
-def _get_matches(pattern, triple):
-    return dict((getattr(a, 'name'), b) for (a,b) in zip(pattern, triple) if getattr(a, 'name', None))
+class QueryResult(object):
+    def __init__(self, variables, rows):
+        self.variables = variables
+        self.rows = rows
+    
+    def __iter__(self):
+        return iter(self.rows)
+
+
+# workers are forked from the process that loaded the store, so they all
+# read the same (copy-on-write) pages rather than getting a pickled copy
+_worker_store = None
+
+def _init_worker(store):
+    global _worker_store
+    _worker_store = store
+    reconnect = getattr(store, 'reconnect', None)
+    if reconnect is not None:
+        reconnect()
+
+def _worker_query(q, limits):
+    try:
+        query = _worker_store.query(q, **limits)
+        return tuple(v.name for v in query.variables), list(query)
+    except ParseException, p:
+        # pyparsing exceptions don't survive pickling, so send back the parts
+        return None, (p.loc, p.msg)
+
+
+class _PendingQuery(object):
+    def __init__(self, q, result):
+        self.q = q
+        self.result = result
+    
+    def ready(self):
+        return self.result.ready()
+    
+    def get(self, timeout=None):
+        names, rows = self.result.get(timeout)
+        if names is None:
+            loc, msg = rows
+            raise ParseException(self.q, loc, msg)
+        return QueryResult(tuple(VariableExpression(n) for n in names), rows)
+
+
+class QueryPool(object):
+    
+    def __init__(self, store, workers=None):
+        from multiprocessing import Pool
+        self.store = store
+        self._pool = Pool(workers, _init_worker, (store,))
+    
+    def query_async(self, q, **limits):
+        return _PendingQuery(q, self._pool.apply_async(_worker_query, (q, limits)))
+    
+    def query(self, q, **limits):
+        return self.query_async(q, **limits).get()
+    
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def _print_pending(p, format):
+    try:
+        print_query_output(p.get(), format)
+    except (ParseException, QueryError), e:
+        print e
+    except Exception, e:
+        # the rest of the queries still run
+        print 'Query failed: %r' % (e,)
+
+def serve_queries(store, lines, workers=None, format='text', **limits):
+    from collections import deque
+    pool = QueryPool(store, workers)
+    pending = deque()
+    try:
+        # results are printed in the order the queries arrived, as soon as
+        # the oldest outstanding one has finished
+        for line in lines:
+            q = line.strip()
+            if q:
+                pending.append(pool.query_async(q, **limits))
+            while pending and pending[0].ready():
+                _print_pending(pending.popleft(), format)
+        while pending:
+            _print_pending(pending.popleft(), format)
+    finally:
+        pool.close()
+
+
+
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+def _json_term(value):
+    if isinstance(value, IRI):
+        return {'type': 'uri', 'value': _unicode(value)}
+    if isinstance(value, BlankNode):
+        return {'type': 'bnode', 'value': _unicode(value[2:])}
+    if isinstance(value, LangString):
+        return {'type': 'literal', 'xml:lang': value.lang, 'value': _unicode(value)}
+    if isinstance(value, TypedLiteral):
+        return {'type': 'literal', 'datatype': value.datatype, 'value': _unicode(value)}
+    if isinstance(value, bool):
+        return {'type': 'literal', 'datatype': _XSD + 'boolean',
+                'value': value and 'true' or 'false'}
+    if isinstance(value, (int, long)):
+        return {'type': 'literal', 'datatype': _XSD + 'integer', 'value': _unicode(value)}
+    if isinstance(value, float):
+        return {'type': 'literal', 'datatype': _XSD + 'double', 'value': repr(value)}
+    return {'type': 'literal', 'value': _unicode(value)}
+
+RESULT_BATCH = 1000
+
+def _batches(rows, size=RESULT_BATCH):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _text_results(names, rows):
+    yield ', '.join(names) + '\n'
+    for batch in _batches(rows):
+        yield ''.join(', '.join([repr(v) for v in row]) + '\n' for row in batch)
+
+def _json_results(names, rows):
+    import json
+    yield '{"head": {"vars": %s}, "results": {"bindings": [' % json.dumps(names)
+    sep = '\n'
+    for batch in _batches(rows):
+        yield sep + ',\n'.join(json.dumps(dict((n, _json_term(v)) for n, v in zip(names, row)
+                                               if v is not None))
+                               for row in batch)
+        sep = ',\n'
+    yield '\n]}}\n'
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    if any(c in value for c in ',"\r\n'):
+        value = '"%s"' % value.replace('"', '""')
+    return value
+
+def _csv_results(names, rows):
+    yield ','.join(names) + '\r\n'
+    for batch in _batches(rows):
+        yield ''.join(','.join([_csv_value(v) for v in row]) + '\r\n' for row in batch)
+
+def _tsv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    if isinstance(value, IRI):
+        return '<%s>' % value
+    if isinstance(value, BlankNode):
+        return str(value)
+    suffix = ''
+    if isinstance(value, LangString):
+        suffix = '@' + value.lang
+    elif isinstance(value, TypedLiteral):
+        suffix = '^^<%s>' % value.datatype
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str.replace(value, '\\', '\\\\').replace('"', '\\"') \
+               .replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return '"%s"%s' % (value, suffix)
+
+def _tsv_results(names, rows):
+    yield '\t'.join('?' + n for n in names) + '\n'
+    for batch in _batches(rows):
+        yield ''.join('\t'.join([_tsv_value(v) for v in row]) + '\n' for row in batch)
+
+
+# The binary format is a header naming the columns followed by batches
+# of rows.  Each batch is its row count and then, for every column, a
+# type tag per row, the column's integers and floats as packed arrays
+# and its strings as an array of lengths followed by their bytes.  A
+# batch of no rows ends the results.
+_BINARY_MAGIC = 'MSPQ\x01'
+
+_UNBOUND, _TRUE, _FALSE, _INTEGER, _FLOAT, _STRING, _UNICODE, _IRI, _BLANK, \
+    _LANG, _TYPED, _BIG_INTEGER = range(12)
+
+def _binary_tag(value):
+    if value is None:
+        return _UNBOUND
+    if isinstance(value, bool):
+        return value and _TRUE or _FALSE
+    if isinstance(value, (int, long)):
+        if -(1 << 63) <= value < (1 << 63):
+            return _INTEGER
+        return _BIG_INTEGER
+    if isinstance(value, float):
+        return _FLOAT
+    if isinstance(value, IRI):
+        return _IRI
+    if isinstance(value, BlankNode):
+        return _BLANK
+    if isinstance(value, LangString):
+        return _LANG
+    if isinstance(value, TypedLiteral):
+        return _TYPED
+    if isinstance(value, unicode):
+        return _UNICODE
+    return _STRING
 
+def _binary_column(values):
+    import struct
+    tags = [_binary_tag(v) for v in values]
+    integers = [v for v, t in zip(values, tags) if t == _INTEGER]
+    floats = [v for v, t in zip(values, tags) if t == _FLOAT]
+    strings = []
+    for v, t in zip(values, tags):
+        if t in (_STRING, _IRI, _BLANK):
+            strings.append(str(v))
+        elif t == _UNICODE:
+            strings.append(v.encode('utf-8'))
+        elif t == _BIG_INTEGER:
+            strings.append(str(v))
+        elif t == _LANG:
+            strings.extend((str(v), v.lang))
+        elif t == _TYPED:
+            strings.extend((str(v), v.datatype))
+    return ''.join([struct.pack('<%dB' % len(tags), *tags),
+                    struct.pack('<I%dq' % len(integers), len(integers), *integers),
+                    struct.pack('<I%dd' % len(floats), len(floats), *floats),
+                    struct.pack('<I%dI' % len(strings), len(strings), *map(len, strings))]
+                   + strings)
 
-def print_query_output(q):
-    print u', '.join(v.name for v in q.variables)
-    for row in q:
-        print u', '.join(repr(r) for r in row)
+def _binary_results(names, rows):
+    import struct
+    yield _BINARY_MAGIC + struct.pack('<H', len(names)) + \
+          ''.join(struct.pack('<H', len(n)) + n for n in names)
+    for batch in _batches(rows):
+        yield struct.pack('<I', len(batch)) + \
+              ''.join(_binary_column(column) for column in zip(*batch))
+    yield struct.pack('<I', 0)
 
-def run_prompt(store):
+def read_binary_results(f):
+    import struct
+    def read(fmt):
+        return struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+    if f.read(len(_BINARY_MAGIC)) != _BINARY_MAGIC:
+        raise ValueError('not a binary result set')
+    names = [f.read(read('<H')[0]) for i in range(read('<H')[0])]
+    def column(count):
+        tags = read('<%dB' % count)
+        integers = iter(read('<%dq' % read('<I')[0]))
+        floats = iter(read('<%dd' % read('<I')[0]))
+        strings = iter([f.read(n) for n in read('<%dI' % read('<I')[0])])
+        constants = { _UNBOUND: None, _TRUE: True, _FALSE: False }
+        values = []
+        for t in tags:
+            if t in constants:
+                values.append(constants[t])
+            elif t == _INTEGER:
+                values.append(next(integers))
+            elif t == _FLOAT:
+                values.append(next(floats))
+            elif t == _STRING:
+                values.append(next(strings))
+            elif t == _UNICODE:
+                values.append(next(strings).decode('utf-8'))
+            elif t == _BIG_INTEGER:
+                values.append(long(next(strings)))
+            elif t == _IRI:
+                values.append(IRI(next(strings)))
+            elif t == _BLANK:
+                values.append(BlankNode(next(strings)))
+            elif t == _LANG:
+                values.append(LangString(next(strings), next(strings)))
+            elif t == _TYPED:
+                values.append(TypedLiteral(next(strings), next(strings)))
+        return values
+    def rows():
+        while True:
+            count = read('<I')[0]
+            if not count:
+                return
+            for row in zip(*[column(count) for name in names]):
+                yield row
+    return names, rows()
+
+RESULT_FORMATS = {
+    'text': ('text/plain; charset=utf-8', _text_results),
+    'json': ('application/sparql-results+json', _json_results),
+    'csv': ('text/csv; charset=utf-8', _csv_results),
+    'tsv': ('text/tab-separated-values; charset=utf-8', _tsv_results),
+    'binary': ('application/x-minisparql-results', _binary_results),
+}
+
+def write_results(q, out, format='text'):
+    names = [v.name for v in q.variables]
+    for data in RESULT_FORMATS[format][1](names, q):
+        out.write(data)
+
+
+def _make_request_handler():
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import urlparse, parse_qs
+    
+    class SparqlRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def do_GET(self):
+            url = urlparse(self.path)
+            self._query(url.path, parse_qs(url.query))
+        
+        def do_POST(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            length = int(self.headers.getheader('content-length') or 0)
+            body = self.rfile.read(length)
+            content_type = (self.headers.getheader('content-type') or '').split(';')[0].strip()
+            if content_type == 'application/sparql-query':
+                params['query'] = [body]
+            elif content_type == 'application/x-www-form-urlencoded':
+                params.update(parse_qs(body))
+            else:
+                return self._error(415, 'Unsupported content type')
+            self._query(url.path, params)
+        
+        def _format(self, params):
+            if 'format' in params:
+                return params['format'][0]
+            accept = self.headers.getheader('accept') or ''
+            for name, (content_type, _) in RESULT_FORMATS.items():
+                if content_type.split(';')[0] in accept:
+                    return name
+            return 'json'
+        
+        def _error(self, code, message):
+            message = unicode(message).encode('utf-8') + '\n'
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(message)))
+            self.end_headers()
+            self.wfile.write(message)
+        
+        def _write_chunk(self, data):
+            self.wfile.write('%X\r\n%s\r\n' % (len(data), data))
+        
+        def _query(self, path, params):
+            if path != self.server.path:
+                return self._error(404, 'Not found')
+            if 'query' not in params:
+                return self._error(400, 'Missing query parameter')
+            fmt = self._format(params)
+            if fmt not in RESULT_FORMATS:
+                return self._error(406, 'Unsupported format %s' % fmt)
+            content_type, serialize = RESULT_FORMATS[fmt]
+            
+            try:
+                names, rows = self.server.execute(params['query'][0])
+                rows = iter(rows)
+                # pull the first row before committing to a 200 so that
+                # errors and timeouts early on get a proper status
+                first = list(islice(rows, 1))
+            except ParseException, p:
+                return self._error(400, p)
+            except QueryError, e:
+                return self._error(503, e)
+            except Exception, e:
+                return self._error(500, 'Query failed: %r' % e)
+            
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            
+            buffered = []
+            size = 0
+            try:
+                for data in serialize(names, chain(first, rows)):
+                    buffered.append(data)
+                    size += len(data)
+                    if size >= 8192:
+                        self._write_chunk(''.join(buffered))
+                        buffered = []
+                        size = 0
+            except Exception:
+                # too late for an error status, so cut the response short
+                # and let the client see a truncated chunked body
+                self.close_connection = 1
+                return
+            if buffered:
+                self._write_chunk(''.join(buffered))
+            self.wfile.write('0\r\n\r\n')
+    
+    return SparqlRequestHandler
+
+
+def _make_server_class():
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    
+    class SparqlServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        
+        def __init__(self, address, store, pool=None, path='/sparql', **limits):
+            HTTPServer.__init__(self, address, _make_request_handler())
+            self.store = store
+            self.pool = pool
+            self.path = path
+            self.limits = limits
+        
+        def execute(self, q):
+            if self.pool is not None:
+                # CPU heavy work goes to a worker process, this thread only waits
+                result = self.pool.query(q, **self.limits)
+            else:
+                result = self.store.query(q, **self.limits)
+            return [v.name for v in result.variables], result
+    
+    return SparqlServer
+
+
+def sparql_server(store, address, pool=None, path='/sparql', **limits):
+    return _make_server_class()(address, store, pool, path, **limits)
+
+
+def serve_http(store, address, workers=None, **limits):
+    pool = None
+    if workers:
+        pool = QueryPool(store, workers)
+    server = sparql_server(store, address, pool, **limits)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if pool is not None:
+            pool.close()
+
+
+def print_query_output(q, format='text'):
+    write_results(q, sys.stdout, format)
+
+def run_prompt(store, **limits):
     import cmd
     class Sparql(cmd.Cmd):
         prompt='sparql> '
         
         def default(self, line):
             try:
-                q = store.query(line)
+                q = store.query(line, **limits)
                 print_query_output(q)
-            except ParseException, p:
+            except (ParseException, QueryError), p:
                 print p
     
     s = Sparql()
@@ -604,21 +4035,55 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option('-e', dest='script', default='', help='script to execute')
     parser.add_option('-n', action="store_false", dest="use_index", default=True, help='disable indexes')
+    parser.add_option('--text-index', action="store_true", dest="text_index", default=False,
+                      help='index string values for regex() and contains() filters')
+    parser.add_option('-w', '--workers', type='int', dest='workers', default=0,
+                      help='run queries read from stdin across this many worker processes')
+    parser.add_option('-p', '--port', type='int', dest='port', default=0,
+                      help='serve the SPARQL protocol over HTTP on this port')
+    parser.add_option('-t', '--timeout', type='float', dest='timeout', default=None,
+                      help='abandon queries that run for longer than this many seconds')
+    parser.add_option('-r', '--max-rows', type='int', dest='max_rows', default=None,
+                      help='abandon queries that produce more than this many intermediate rows')
+    parser.add_option('--rdfs', action='store_true', dest='rdfs', default=False,
+                      help='derive the RDFS entailments of the triples and query them too')
+    parser.add_option('--db', dest='db', default=None,
+                      help='keep the triples in this database file rather than in memory')
+    parser.add_option('--cache-size', type='int', dest='cache_size', default=2000,
+                      help='number of database pages to cache in memory')
+    parser.add_option('-f', '--format', type='choice', dest='format', default='text',
+                      choices=sorted(RESULT_FORMATS),
+                      help='write results as %s' % ', '.join(sorted(RESULT_FORMATS)))
     options, args = parser.parse_args()
     script = options.script
-    
-    if options.use_index:
-        store = IndexedTripleStore()
+    limits = dict(timeout=options.timeout, max_rows=options.max_rows)
+    if options.rdfs:
+        if options.db or not options.use_index:
+            parser.error('--rdfs needs the in-memory indexes')
+        limits['inferred'] = True
+    
+    if options.db:
+        store = DiskTripleStore(options.db, options.cache_size)
+    elif options.use_index:
+        store = IndexedTripleStore(options.text_index, inference=options.rdfs)
     else:
         store = TripleStore()
-    from fileinput import input
-    if not script and args:
-        store.import_file(input(args))
-        run_prompt(store)
+    # a database may already hold everything, so files are optional
+    have_data = args or options.db
+    if args:
+        for path in args:
+            store.import_file(path)
+    elif script and not options.db:
+        store.import_file(sys.stdin)
+    if options.port and have_data:
+        serve_http(store, ('', options.port), options.workers, **limits)
+    elif options.workers and have_data:
+        serve_queries(store, sys.stdin, options.workers, options.format, **limits)
+    elif not script and have_data:
+        run_prompt(store, **limits)
     elif script:
-        store.import_file(input(args))
         try:
-            q = store.query(script)
-            print_query_output(q)
-        except ParseException, p:
+            q = store.query(script, **limits)
+            print_query_output(q, options.format)
+        except (ParseException, QueryError), p:
             print p
\ No newline at end of file
@@ -1,7 +1,14 @@
 from minisparql import TripleStore, Pattern, PatternGroup, OptionalGroup, \
                    UnionGroup, Index, VariableExpression, LiteralExpression, \
-                   IndexedTripleStore
+                   IndexedTripleStore, QueryPool, sparql_server, \
+                   QueryTimeout, QueryTooLarge, QueryCancelled, Solution, \
+                   RangePattern, TextPattern, DiskTripleStore, \
+                   PersistentTripleStore, ShardedTripleStore, ShardedStar, StarJoin, PathPattern, ViewPattern, TrieJoin, \
+                   TurtleParser, IRI, BlankNode, LangString, TypedLiteral, \
+                   write_results, read_binary_results, RESULT_BATCH, UNBOUND
+from pyparsing import ParseException
 import unittest
+import os
 
 class TestParsing(unittest.TestCase):
     
@@ -106,6 +113,8 @@ class TestExpressionParser(unittest.TestCase):
                                   ('(2 * ?a < 10)', 5, False),
                                   ('(2 * ?a < 10 && ?a > 3)', 3, False),
                                   ('(2 * ?a < 10 || ?a > 3)', 3, True),
+                                  ('(?a > 1 && ?a > 2 && ?a < 4)', 3, True),
+                                  ('(?a > 1 && ?a > 2 && ?a < 4)', 4, False),
                                   ('(!(2 * ?a < 10))', 4, False)]: 
             toks = p.parseString(expr)
             self.assertTrue(toks is not None)
@@ -143,6 +152,39 @@ class TestExpressionParser(unittest.TestCase):
             self.assertEqual(expected, e.resolve(dict(a=a)))
 
 
+class TestSolution(unittest.TestCase):
+    
+    def test_bindings(self):
+        s = Solution()
+        s1 = Solution(s, 'a', 1)
+        s2 = Solution(s1, 'b', 2)
+        self.assertEqual(None, s.get('a'))
+        self.assertEqual(1, s1.get('a'))
+        self.assertEqual(None, s1.get('b'))
+        self.assertEqual(1, s2['a'])
+        self.assertEqual(2, s2['b'])
+        self.assertRaises(KeyError, lambda: s2['c'])
+        self.assertTrue('a' in s2)
+        self.assertFalse('c' in s2)
+        self.assertEqual([('a', 1), ('b', 2)], s2.items())
+        self.assertEqual(2, len(s2))
+    
+    def test_shares_parent(self):
+        s = Solution(Solution(), 'a', 1)
+        s1 = Solution(s, 'b', 2)
+        s2 = Solution(s, 'b', 3)
+        self.assertTrue(s1.parent is s2.parent)
+        self.assertEqual(dict(a=1, b=2), s1)
+        self.assertEqual(dict(a=1, b=3), s2)
+    
+    def test_equality(self):
+        s = Solution.from_dict(dict(a=1, b=2))
+        self.assertEqual(dict(a=1, b=2), s)
+        self.assertEqual(s, Solution(Solution(Solution(), 'b', 2), 'a', 1))
+        self.assertNotEqual(dict(a=1), s)
+        self.assertEqual(hash(s), hash(Solution.from_dict(dict(b=2, a=1))))
+
+
 class TestMatchTriples(unittest.TestCase):
     store = TripleStore()
     
@@ -191,12 +233,863 @@ class TestMatchTriples(unittest.TestCase):
                                         VariableExpression('value')
                                     )
                             )))
+    
+    def test_triples(self):
+        triples = [('t', 'name', 'T'), ('t', 'legs', 2)]
+        self.store.add_triples(*triples)
+        try:
+            self.assertTrue(set(triples) <= set(self.store.triples()))
+            self.assertTrue(all(isinstance(t, tuple) and len(t) == 3 for t in self.store.triples()))
+        finally:
+            self.store.remove_triples(*triples)
+        self.assertFalse(set(triples) & set(self.store.triples()))
+    
+    def test_match_unbound_sentinel(self):
+        # false values are as bound as any other
+        triples = [('', 'score', 0), ('x', 'score', 1), ('x', 0, 'zero'), ('y', 0, '')]
+        self.store.add_triples(*triples)
+        try:
+            self._check_same_contents([dict(o=0)], list(self.store.match_triples(
+                (LiteralExpression(''), LiteralExpression('score'), VariableExpression('o')))))
+            self._check_same_contents([dict(s='')], list(self.store.match_triples(
+                (VariableExpression('s'), LiteralExpression('score'), LiteralExpression(0)))))
+            self._check_same_contents([dict(s='x', o='zero'), dict(s='y', o='')],
+                list(self.store.match_triples(
+                    (VariableExpression('s'), LiteralExpression(0), VariableExpression('o')))))
+            self._check_same_contents([dict(s='y', p=0)], list(self.store.match_triples(
+                (VariableExpression('s'), VariableExpression('p'), LiteralExpression('')),
+                dict(p=0))))
+        finally:
+            self.store.remove_triples(*triples)
 
 
 class TestMatchTriplesIndexed(TestMatchTriples):
     store = IndexedTripleStore()
 
 
+class TestMatchTriplesDisk(TestMatchTriples):
+    store = DiskTripleStore(':memory:')
+
+
+class TestDiskTripleStore(unittest.TestCase):
+    
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp('.db')
+        os.close(fd)
+    
+    def tearDown(self):
+        os.remove(self.path)
+    
+    def test_persists(self):
+        store = DiskTripleStore(self.path)
+        store.add_triples(('a', 'name', 'name-a'), ('b', 'name', 'name-b'),
+                          ('a', 'height', 100), ('b', 'height', 2.5), ('a', 'fly', True))
+        store.close()
+        
+        store = DiskTripleStore(self.path, cache_size=10, term_cache_size=2)
+        self.assertEqual(
+            [('a', 'name-a', 100), ('b', 'name-b', 2.5)],
+            sorted(store.query('SELECT ?id ?name ?height WHERE { ?id name ?name . ?id height ?height }'))
+        )
+        self.assertEqual([(True,)], list(store.query('SELECT ?fly WHERE { a fly ?fly }')))
+        self.assertTrue(type(list(store.query('SELECT ?fly WHERE { a fly ?fly }'))[0][0]) is bool)
+        self.assertEqual([], list(store.query('SELECT ?id WHERE { ?id height 3 }')))
+        self.assertEqual(["'a'"], [repr(r[0]) for r in store.query('SELECT ?id WHERE { ?id fly ?f }')])
+        store.close()
+    
+    def test_term_types(self):
+        terms = [1.0, 1, LangString('Robin', 'en'), LangString('Robin', 'fr'), 'Robin',
+                 TypedLiteral('Robin', 'http://t'), True]
+        triples = [('s%d' % i, 'w', t) for i, t in enumerate(terms)]
+        for order in (triples, triples[::-1]):
+            store = DiskTripleStore(self.path)
+            store.clear_triples()
+            store.add_triples(*order)
+            store.close()
+            store = DiskTripleStore(self.path)
+            found = sorted(store.query('SELECT ?s ?w WHERE { ?s w ?w }'))
+            self.assertEqual([('s%d' % i, t) for i, t in enumerate(terms)], found)
+            self.assertEqual([type(t) for t in terms], [type(w) for s, w in found])
+            store.close()
+    
+    def test_threads(self):
+        import threading
+        store = DiskTripleStore(self.path)
+        store.add_triples(*[(str(i), 'legs', i) for i in range(500)])
+        errors = []
+        def work(n):
+            try:
+                for i in range(20):
+                    store.add_triples(('t%d' % n, 'run', i))
+                    self.assertEqual(500, len(list(store.query('SELECT ?x WHERE { ?x legs ?l }'))))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(80, len(list(store.query('SELECT ?x WHERE { ?x run ?i }'))))
+        store.close()
+    
+    def test_duplicates_ignored(self):
+        store = DiskTripleStore(self.path)
+        store.add_triples(('a', 'name', 'name-a'), ('a', 'name', 'name-a'))
+        store.add_triples(('a', 'name', 'name-a'))
+        self.assertEqual([('a',)], list(store.query('SELECT ?id WHERE { ?id name ?name }')))
+        store.close()
+
+
+class TestRemoveTriples(unittest.TestCase):
+    
+    def _check_remove(self, store):
+        store.add_triples(('a', 'name', 'name-a'), ('b', 'name', 'name-b'),
+                          ('a', 'legs', 2), ('b', 'legs', 4))
+        store.remove_triples(('a', 'name', 'name-a'), ('b', 'legs', 4), ('c', 'legs', 1))
+        self.assertEqual([('b', 'name-b')],
+                         list(store.query('SELECT ?id ?name WHERE { ?id name ?name }')))
+        self.assertEqual([('a',)],
+                         list(store.query('SELECT ?id WHERE { ?id legs ?legs FILTER (?legs > 1) }')))
+        self.assertEqual([],
+                         list(store.query('SELECT ?id WHERE { ?id name ?n FILTER regex(?n, "name-a") }')))
+    
+    def test_remove(self):
+        self._check_remove(TripleStore())
+    
+    def test_remove_indexed(self):
+        store = IndexedTripleStore(text_index=True)
+        self._check_remove(store)
+        self.assertEqual(['legs'], store._indexes[(0, 1, 2)]._index['a'].keys())
+    
+    def test_remove_disk(self):
+        self._check_remove(DiskTripleStore(':memory:'))
+
+
+class TestPersistentTripleStore(unittest.TestCase):
+    
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+    
+    def _names(self, store):
+        return sorted(store.query('SELECT ?id ?name WHERE { ?id name ?name }'))
+    
+    def test_named_graphs(self):
+        store = PersistentTripleStore(self.directory)
+        store.add_quads(('a', 'name', 'name-a', 'g1'), ('b', 'name', 'name-b', 'g2'))
+        store.compact()
+        store.add_quads(('c', 'name', 'name-c', 'g1'))
+        store.remove_quads(('a', 'name', 'name-a', 'g1'))
+        store.drop_graph('g2')
+        store.close()
+        
+        store = PersistentTripleStore(self.directory)
+        self.assertEqual([('c', 'name', 'name-c', 'g1')], list(store.quads()))
+        store.close()
+    
+    def test_log_replayed(self):
+        store = PersistentTripleStore(self.directory)
+        store.add_triples(('a', 'name', 'name-a'), ('b', 'name', 'name-b'))
+        store.remove_triples(('a', 'name', 'name-a'))
+        store.add_triples(('c', 'name', 'name-c'))
+        store.close()
+        
+        store = PersistentTripleStore(self.directory)
+        self.assertEqual([('b', 'name-b'), ('c', 'name-c')], self._names(store))
+        store.close()
+    
+    def test_group_commit(self):
+        store = PersistentTripleStore(self.directory, group_size=3)
+        store.add_triples(('a', 'name', 'name-a'), ('b', 'name', 'name-b'))
+        self.assertEqual([], self._names(PersistentTripleStore(self.directory)))
+        store.add_triples(('c', 'name', 'name-c'))
+        self.assertEqual(3, len(self._names(PersistentTripleStore(self.directory))))
+        store.add_triples(('d', 'name', 'name-d'))
+        store.commit()
+        self.assertEqual(4, len(self._names(PersistentTripleStore(self.directory))))
+    
+    def test_compact(self):
+        store = PersistentTripleStore(self.directory)
+        store.add_triples(*[('s%d' % i, 'name', 'name-%d' % i) for i in range(25)])
+        store.remove_triples(('s0', 'name', 'name-0'))
+        store.BATCH = 10
+        store.compact()
+        self.assertEqual(0, os.path.getsize(os.path.join(self.directory, 'log')))
+        store.add_triples(('a', 'name', 'name-a'))
+        store.close()
+        
+        store = PersistentTripleStore(self.directory)
+        names = self._names(store)
+        self.assertEqual(25, len(names))
+        self.assertTrue(('a', 'name-a') in names)
+        self.assertFalse(('s0', 'name-0') in names)
+    
+    def test_torn_log_tail(self):
+        store = PersistentTripleStore(self.directory)
+        store.add_triples(('a', 'name', 'name-a'))
+        store.close()
+        log = os.path.join(self.directory, 'log')
+        size = os.path.getsize(log)
+        with open(log, 'ab') as f:
+            f.write('\x80\x02(U\x01+')
+        
+        store = PersistentTripleStore(self.directory)
+        self.assertEqual([('a', 'name-a')], self._names(store))
+        self.assertEqual(size, os.path.getsize(log))
+        store.add_triples(('b', 'name', 'name-b'))
+        store.close()
+        self.assertEqual(2, len(self._names(PersistentTripleStore(self.directory))))
+
+
+class TestMatchTriplesSharded(TestMatchTriples):
+    store = ShardedTripleStore(3)
+
+
+class StoreComparison(object):
+    # queries run against a store and a plain store with the same triples
+    
+    def load(self, triples, store=None, plain=None):
+        self.store = IndexedTripleStore() if store is None else store
+        self.plain = TripleStore() if plain is None else plain
+        self.store.add_triples(*triples)
+        self.plain.add_triples(*triples)
+    
+    def compare(self, q, operator=None, used=True, first=False, expected=None):
+        q1 = self.store.query(q)
+        if operator is not None:
+            planned = getattr(q1.patterns, 'patterns', (q1.patterns,))
+            if first:
+                planned = planned[:1]
+            self.assertEqual(used, any(isinstance(p, operator) for p in planned))
+        results = sorted(q1)
+        self.assertEqual(sorted(self.plain.query(q)), results)
+        if expected is not None:
+            self.assertEqual(sorted(expected), results)
+        return q1
+
+
+class TestShardedTripleStore(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        triples = [('bird%s' % c, 'name', 'name-%s' % c) for c in 'abcdefgh'] + \
+                  [('bird%s' % c, 'color', 'red') for c in 'aceg'] + \
+                  [('bird%s' % c, 'legs', 2) for c in 'abcd'] + \
+                  [('birda', 'eats', 'birdb'), ('birdb', 'eats', 'birdc')]
+        self.load(triples, ShardedTripleStore(3), IndexedTripleStore())
+    
+    def _check(self, q):
+        self.compare(q)
+    
+    def test_partitioned(self):
+        sizes = [len(list(shard.triples())) for shard in self.store.shards]
+        self.assertEqual(18, sum(sizes))
+        self.assertTrue(all(sizes))
+        for shard in self.store.shards:
+            for t in shard.triples():
+                self.assertTrue(shard is self.store.shards[self.store._shard_number(t[0])])
+    
+    def test_star_pushed_down(self):
+        q = 'SELECT ?name ?legs WHERE { ?id name ?name . ?id color red . ?id legs ?legs }'
+        planned = self.store.query(q).patterns.patterns
+        self.assertTrue(isinstance(planned[0], ShardedStar))
+        self._check(q)
+    
+    def test_queries(self):
+        self._check('SELECT ?id ?name WHERE { ?id name ?name }')
+        self._check('SELECT ?name WHERE { birdc name ?name }')
+        self._check('SELECT ?a ?c WHERE { ?a eats ?b . ?b eats ?c }')
+        self._check('SELECT ?n ?m WHERE { ?a eats ?b . ?a name ?n . ?b name ?m OPTIONAL { ?b legs ?l } }')
+        self._check('SELECT ?id WHERE { { ?id color red } UNION { ?id legs 2 } }')
+        self._check('SELECT ?id ?l WHERE { ?id name ?n . ?id legs ?l FILTER (?l > 1) } ORDER BY ?id')
+    
+    def test_remove(self):
+        self.store.remove_triples(('birda', 'name', 'name-a'))
+        self.plain.remove_triples(('birda', 'name', 'name-a'))
+        self._check('SELECT ?id ?name WHERE { ?id name ?name . ?id color ?c }')
+
+
+class TestStarJoin(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        triples = [('bird%s' % c, 'name', 'name-%s' % c) for c in 'abcdefgh'] + \
+                  [('bird%s' % c, 'color', 'red') for c in 'aceg'] + \
+                  [('birda', 'color', 'blue'), ('birdb', 'likes', 'birdb'),
+                   ('birdc', 'likes', 'birda'), ('birda', 'likes', 'red')]
+        self.load(triples)
+    
+    def _check(self, q, star=True):
+        self.compare(q, StarJoin, star)
+    
+    def test_star(self):
+        self._check('SELECT ?id ?name ?c WHERE { ?id name ?name . ?id color ?c }')
+        self._check('SELECT ?name WHERE { ?id name ?name . ?id color red }')
+        self._check('SELECT ?name WHERE { birda name ?name . birda color ?c }', star=False)
+        self._check('SELECT ?id WHERE { ?id name ?name . ?id nothing ?c }')
+    
+    def test_repeated_variables(self):
+        self._check('SELECT ?id WHERE { ?id name ?name . ?id likes ?id }')
+        self._check('SELECT ?id WHERE { ?id color ?c . ?id likes ?c }')
+    
+    def test_bound_from_outside(self):
+        self._check('SELECT ?id ?c WHERE { ?x likes ?id . ?id name ?name . ?id color ?c }')
+        self._check('SELECT ?id ?c WHERE { ?id name ?name OPTIONAL { ?id color ?c . ?id likes ?l } }',
+                    star=False)
+
+
+class TestPropertyPaths(unittest.TestCase):
+    
+    def setUp(self):
+        self.stores = [TripleStore(), IndexedTripleStore(), IndexedTripleStore(path_cache_size=10)]
+        for store in self.stores:
+            store.add_triples(('a', 'sub', 'b'), ('b', 'sub', 'c'), ('c', 'sub', 'a'),
+                              ('d', 'sub', 'c'), ('a', 'name', 'A'), ('c', 'name', 'C'),
+                              ('b', 'knows', 'd'))
+    
+    def _check(self, q, expected):
+        for store in self.stores:
+            query = store.query(q)
+            self.assertTrue(isinstance(query.patterns, PathPattern))
+            self.assertEqual(sorted(expected), sorted(query))
+    
+    def test_paths(self):
+        self._check('SELECT ?x WHERE { a sub/name ?x }', [])
+        self._check('SELECT ?x WHERE { b sub/name ?x }', [('C',)])
+        self._check('SELECT ?x WHERE { a ^sub ?x }', [('c',)])
+        self._check('SELECT ?x ?y WHERE { ?x sub|knows ?y }',
+                    [('a', 'b'), ('b', 'c'), ('b', 'd'), ('c', 'a'), ('d', 'c')])
+        self._check('SELECT ?x WHERE { ?x ^name/sub+ a }', [('A',), ('C',)])
+    
+    def test_closure(self):
+        self._check('SELECT ?x WHERE { a sub+ ?x }', [('a',), ('b',), ('c',)])
+        self._check('SELECT ?x WHERE { d sub* ?x }', [('a',), ('b',), ('c',), ('d',)])
+        self._check('SELECT ?x WHERE { ?x sub* a }', [('a',), ('b',), ('c',), ('d',)])
+        self._check('SELECT ?x WHERE { a sub? ?x }', [('a',), ('b',)])
+        self._check('SELECT ?x WHERE { ?x sub+ ?x }', [('a',), ('b',), ('c',)])
+        self._check('SELECT ?x WHERE { ?x (sub/sub)+/name A }', [('a',), ('b',), ('c',), ('d',)])
+    
+    def test_cache_invalidated(self):
+        self._check('SELECT ?x WHERE { d sub+ ?x }', [('a',), ('b',), ('c',)])
+        for store in self.stores:
+            store.remove_triples(('c', 'sub', 'a'))
+        self._check('SELECT ?x WHERE { d sub+ ?x }', [('c',)])
+
+
+class CountingStore(IndexedTripleStore):
+    
+    def __init__(self):
+        IndexedTripleStore.__init__(self)
+        self.probes = []
+    
+    def match_triples(self, pattern, existing=None):
+        self.probes.append(pattern)
+        return IndexedTripleStore.match_triples(self, pattern, existing)
+
+
+class TestOptionalBatching(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        triples = [('bird%d' % i, 'color', 'c%d' % (i % 3)) for i in range(30)] + \
+                  [('c0', 'label', 'zero'), ('c1', 'label', 'one'), ('c1', 'label', 'uno'),
+                   ('bird1', 'legs', 2)]
+        self.load(triples, CountingStore())
+    
+    def _check(self, q):
+        self.compare(q)
+    
+    def test_probes_once_per_key(self):
+        q = 'SELECT ?id ?l WHERE { ?id color ?c OPTIONAL { ?c label ?l } }'
+        self._check(q)
+        del self.store.probes[:]
+        list(self.store.query(q))
+        self.assertEqual(4, len(self.store.probes))
+    
+    def test_optional(self):
+        self._check('SELECT ?id ?c ?l ?n WHERE { ?id color ?c OPTIONAL { ?c label ?l } OPTIONAL { ?id legs ?n } }')
+        self._check('SELECT ?id ?x WHERE { ?id color ?c OPTIONAL { ?x label ?c } }')
+        self._check('SELECT ?id ?l WHERE { ?id color ?c OPTIONAL { ?c label ?l OPTIONAL { ?id legs ?n } } }')
+        self._check('SELECT ?id ?l WHERE { ?id color ?c OPTIONAL { ?c label ?l FILTER regex(?id, "^bird1$") } }')
+
+
+class TestMaterializedViews(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        triples = [('birda', 'name', 'A'), ('birdb', 'name', 'B'), ('birda', 'color', 'red'),
+                   ('birdb', 'color', 'blue'), ('birdc', 'color', 'red'), ('birdb', 'size', 'small')]
+        self.load(triples)
+        self.store.materialize('colors', 'SELECT * WHERE { ?id name ?name . ?id color ?color }')
+    
+    def _check(self, q, view=True):
+        self.compare(q, ViewPattern, view, first=True)
+    
+    def _change(self, add=(), remove=()):
+        for store in (self.store, self.plain):
+            store.add_triples(*add)
+            store.remove_triples(*remove)
+    
+    def test_rewrite(self):
+        self._check('SELECT ?n ?c WHERE { ?x color ?c . ?x name ?n }')
+        self._check('SELECT ?n WHERE { ?x color red . ?x name ?n }')
+        self._check('SELECT ?n ?s WHERE { ?x name ?n . ?x color blue . ?x size ?s }')
+        self._check('SELECT ?n WHERE { ?x name ?n . ?y color ?c }', view=False)
+    
+    def test_maintained(self):
+        self._change(add=[('birdc', 'name', 'C'), ('birdd', 'name', 'D'), ('birdb', 'color', 'red')])
+        self._check('SELECT ?n ?c WHERE { ?x color ?c . ?x name ?n }')
+        self._change(remove=[('birda', 'color', 'red'), ('birdb', 'name', 'B')])
+        self._check('SELECT ?n ?c WHERE { ?x color ?c . ?x name ?n }')
+        self.store.clear_triples()
+        self.assertEqual([], list(self.store.query('SELECT ?n WHERE { ?x color ?c . ?x name ?n }')))
+    
+    def test_drop_view(self):
+        self.store.drop_view('colors')
+        self._check('SELECT ?n ?c WHERE { ?x color ?c . ?x name ?n }', view=False)
+
+
+class TestTrieJoin(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        people = 'abcdefg'
+        triples = [(x, 'knows', y) for i, x in enumerate(people) for y in people[i + 1:i + 4]] + \
+                  [('g', 'knows', 'a'), ('f', 'knows', 'b'), ('e', 'knows', 'a'),
+                   ('a', 'name', 'A'), ('c', 'name', 'C'), ('a', 'likes', 'c')]
+        self.load(triples)
+    
+    def _check(self, q, trie=True):
+        self.compare(q, TrieJoin, trie)
+    
+    def test_cycles(self):
+        self._check('SELECT ?a ?b ?c WHERE { ?a knows ?b . ?b knows ?c . ?c knows ?a }')
+        self._check('SELECT ?a ?b ?c ?d WHERE { ?a knows ?b . ?b knows ?c . ?c knows ?d . ?d knows ?a }')
+        self._check('SELECT ?a ?b ?c WHERE { ?a knows ?b . ?b knows ?c . ?a knows ?c }')
+    
+    def test_with_other_patterns(self):
+        self._check('SELECT ?n ?b ?c WHERE { ?a name ?n . ?a knows ?b . ?b knows ?c . ?c knows ?a }')
+        self._check('SELECT ?b ?c WHERE { ?a likes ?c . ?a knows ?b . ?b knows ?c }')
+        self._check('SELECT ?b ?c WHERE { a knows ?b . ?b knows ?c . ?c knows a }', trie=False)
+    
+    def test_acyclic(self):
+        self._check('SELECT ?a ?c WHERE { ?a knows ?b . ?b knows ?c }', trie=False)
+        self._check('SELECT ?a ?b WHERE { ?a knows ?b . ?a likes ?b }', trie=False)
+    
+    def test_bound_patterns_checked(self):
+        triples = [('a', 'likes', 'b'), ('b', 'likes', 'c'), ('a', 'knows', 'x'),
+                   ('x', 'knows', 'y'), ('y', 'knows', 'a')]
+        self.load(triples)
+        self._check('SELECT ?a ?b ?c WHERE { ?a likes ?b . ?b likes ?c FILTER(?a != "z") '
+                    '?a knows ?b . ?b knows ?c . ?c knows ?a }')
+
+
+TURTLE = '''@prefix ex: <http://example.org/> .
+PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+# a comment
+ex:robin a ex:Bird ; ex:name "Robin"@en , "Rouge-gorge"@fr ;
+    ex:legs "2"^^xsd:integer ; ex:weight 1.5e1 ; ex:code "x"^^ex:custom ;
+    ex:note """two
+lines with "quotes\\"""" .
+_:b1 ex:knows [ ex:name "anon\u00e9" ] .
+ex:list ex:items ( 1 2 ) .
+<http://example.org/s> <http://example.org/p> true .
+robin name Robin .
+'''
+
+class TestPlanCache(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        plain = IndexedTripleStore()
+        plain.PLAN_CACHE_SIZE = 0
+        self.load([('a', 'knows', 'b'), ('b', 'knows', 'c'), ('c', 'knows', 'a'),
+                   ('a', 'name', 'A'), ('b', 'name', 'B'), ('a', 'age', 3), ('b', 'age', 30)],
+                  plain=plain)
+    
+    def _check(self, q):
+        return self.compare(q).patterns
+    
+    def _plans(self):
+        return len(self.store._plan_cache._plans)
+    
+    def test_same_shape(self):
+        p1 = self._check('SELECT ?n WHERE { ?x name ?n . ?x age 3 }')
+        p2 = self._check('SELECT ?m WHERE { ?y name ?m . ?y age 30 }')
+        self.assertEqual(1, self._plans())
+        self.assertEqual('y', p2.patterns[0].subject.name)
+        self.assertTrue(p1 is self._check('SELECT ?n WHERE { ?x name ?n . ?x age 3 }'))
+        self._check('SELECT ?n WHERE { ?x name ?n . ?x age ?a }')
+        self._check('SELECT ?n WHERE { ?x name ?n . ?x age "3" }')
+        self.assertEqual(3, self._plans())
+    
+    def test_renamed_operators(self):
+        self._check('SELECT ?a ?b ?c WHERE { ?a knows ?b . ?b knows ?c . ?c knows ?a }')
+        p = self._check('SELECT ?x ?y ?z WHERE { ?x knows ?y . ?y knows ?z . ?z knows ?x }')
+        self.assertTrue(isinstance(p.patterns[0], TrieJoin))
+        self.assertEqual(set('xyz'), set(p.patterns[0].order))
+        self._check('SELECT ?a ?n WHERE { ?a knows ?b OPTIONAL { ?b name ?n } }')
+        p = self._check('SELECT ?x ?m WHERE { ?x knows ?y OPTIONAL { ?y name ?m } }')
+        self.assertEqual(('y', 'm'), p.patterns[1].names)
+        self._check('SELECT ?x WHERE { ?x knows/name A }')
+        self._check('SELECT ?knows WHERE { ?knows knows/name B }')
+        self.assertEqual(3, self._plans())
+    
+    def test_literal_named_like_variable(self):
+        triples = [('r', 'p', 'x'), ('q', 'p', 'y'), ('z', 'p', 'z')]
+        self.store.add_triples(*triples)
+        self.plain.add_triples(*triples)
+        self._check('SELECT ?x WHERE { ?x p x }')
+        self._check('SELECT ?y WHERE { ?y p x }')
+        self.assertEqual([('r',)], list(self.store.query('SELECT ?y WHERE { ?y p x }')))
+        self._check('SELECT ?y ?n WHERE { ?y knows ?x OPTIONAL { ?x name ?n . ?x knows x } }')
+        p = self._check('SELECT ?x ?n WHERE { ?x knows ?y OPTIONAL { ?y name ?n . ?y knows x } }')
+        self.assertEqual(('y', 'n'), p.patterns[1].names)
+    
+    def test_filter_bounds(self):
+        p = self._check('SELECT ?x WHERE { ?x age ?a FILTER (?a > 1 && ?a > 10) }')
+        self.assertEqual(10, p.patterns[0].low[0].value)
+        p = self._check('SELECT ?x WHERE { ?x age ?a FILTER (?a > 20 && ?a > 2) }')
+        self.assertEqual(20, p.patterns[0].low[0].value)
+    
+    def test_view_constants(self):
+        self.store.materialize('old', 'SELECT * WHERE { ?x age 30 . ?x name ?n }')
+        p = self._check('SELECT ?n WHERE { ?x name ?n . ?x age 30 }')
+        self.assertTrue(isinstance(p.patterns[0], ViewPattern))
+        p = self._check('SELECT ?n WHERE { ?x name ?n . ?x age 3 }')
+        self.assertFalse(isinstance(p.patterns[0], ViewPattern))
+        self.store.drop_view('old')
+        p = self._check('SELECT ?n WHERE { ?x name ?n . ?x age 30 }')
+        self.assertFalse(isinstance(p.patterns[0], ViewPattern))
+    
+    def test_replanned_on_growth(self):
+        q = 'SELECT ?n WHERE { ?x name ?n }'
+        p = self._check(q)
+        self.assertTrue(p is self._check(q))
+        self.store.add_triples(('c', 'name', 'C'))
+        self.assertTrue(p is self.store.query(q).patterns)
+        self.store.add_triples(*[(i, 'name', str(i)) for i in range(10)])
+        self.assertFalse(p is self.store.query(q).patterns)
+
+
+class TestAdaptiveJoins(unittest.TestCase):
+    
+    class CountingStore(IndexedTripleStore):
+        lookups = 0
+        
+        def match_triples(self, pattern, existing=None):
+            self.lookups += 1
+            return IndexedTripleStore.match_triples(self, pattern, existing)
+    
+    def setUp(self):
+        self.store = self.CountingStore()
+        # nearly every subject is red, but evenly spread colours would
+        # make it one in a hundred
+        self.store.add_triples(*[('s%d' % i, 'color', 'red') for i in range(2000)])
+        self.store.add_triples(*[('t%d' % i, 'color', 'c%d' % i) for i in range(99)])
+        self.store.add_triples(*[('o%d' % i, 'owns', 's%d' % (i * 4)) for i in range(500)])
+        self.query = 'SELECT ?s ?o WHERE { ?s color red . ?o owns ?s }'
+        self.expected = sorted(('s%d' % (i * 4), 'o%d' % i) for i in range(500))
+    
+    def test_estimate(self):
+        p = self.store.parse_query(self.query).query[2].patterns[0]
+        self.assertAlmostEqual(20.99, p.store._estimate(p.pattern, ()))
+        self.assertAlmostEqual(0.01, p.store._estimate(p.pattern, ('s',)))
+        self.assertEqual(0, p.store._estimate((p.pattern[0], LiteralExpression('size'),
+                                               p.pattern[2]), ()))
+    
+    def test_switch_to_hash_join(self):
+        self.store.ADAPTIVE_MIN_ROWS = 0
+        self.assertEqual(self.expected, sorted(self.store.query(self.query)))
+        # the second pattern was looked up for the first 501 solutions
+        # and then matched just once more
+        self.assertEqual(503, self.store.lookups)
+    
+    def test_no_switch(self):
+        self.store.ADAPTIVE_FACTOR = None
+        self.assertEqual(self.expected, sorted(self.store.query(self.query)))
+        self.assertEqual(2001, self.store.lookups)
+        self.store.lookups = 0
+        self.store.ADAPTIVE_FACTOR = 4
+        self.store.ADAPTIVE_MIN_ROWS = 5000
+        self.assertEqual(self.expected, sorted(self.store.query(self.query)))
+        self.assertEqual(2001, self.store.lookups)
+    
+    def test_repeated_variable(self):
+        store = IndexedTripleStore()
+        store.add_triples(*[('hub', 'likes', 'w%d' % i) for i in range(3000)])
+        store.add_triples(*[('x%d' % i, 'likes', 'y%d' % i) for i in range(3000)])
+        store.add_triples(*[('q%d' % i, 'same', 'w%d' % i) for i in range(0, 3000, 10)])
+        q = 'SELECT ?w WHERE { hub likes ?w . ?w same ?w }'
+        self.assertEqual([], list(store.query(q)))
+        store.add_triples(('w5', 'same', 'w5'))
+        self.assertEqual([('w5',)], list(store.query(q)))
+    
+    def test_hash_join(self):
+        from minisparql import _hash_join, Solution
+        p = Pattern(self.store, VariableExpression('o'), LiteralExpression('owns'),
+                    VariableExpression('s'))
+        left = [Solution.from_dict(dict(s='s0', x=1)), Solution.from_dict(dict(s='s1')),
+                Solution.from_dict(dict(o='o1', s='s4')), Solution.from_dict(dict(o='o2'))]
+        self.assertEqual([dict(s='s0', x=1, o='o0'), dict(o='o1', s='s4'), dict(o='o2', s='s8')],
+                         [m.to_dict() for m in _hash_join(iter(left), p, None)])
+    
+
+class TestInference(unittest.TestCase):
+    
+    RDFS = 'http://www.w3.org/2000/01/rdf-schema#'
+    TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+    PREFIXES = 'PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> '
+    
+    def setUp(self):
+        self.store = IndexedTripleStore(inference=True)
+        self.store.add_triples(('Robin', self.RDFS + 'subClassOf', 'Bird'),
+                               ('Bird', self.RDFS + 'subClassOf', 'Animal'),
+                               ('eats', self.RDFS + 'domain', 'Animal'),
+                               ('eats', self.RDFS + 'range', 'Food'),
+                               ('devours', self.RDFS + 'subPropertyOf', 'eats'),
+                               ('robin', self.TYPE, 'Robin'),
+                               ('cat', 'devours', 'robin'))
+    
+    def _types(self, subject):
+        q = self.PREFIXES + 'SELECT ?t WHERE { %s rdf:type ?t }' % subject
+        return sorted(t for t, in self.store.query(q, inferred=True))
+    
+    def _closure(self):
+        # everything derived by chaining the rules from scratch
+        fresh = IndexedTripleStore(inference=True)
+        fresh.add_triples(*self.store.triples())
+        return sorted(fresh._inferred().triples())
+    
+    def test_entailments(self):
+        self.assertEqual(['Animal', 'Bird', 'Food', 'Robin'], self._types('robin'))
+        self.assertEqual(['Animal'], self._types('cat'))
+        self.assertEqual([('robin',)], list(self.store.query('SELECT ?x WHERE { cat eats ?x }',
+                                                             inferred=True)))
+        self.assertEqual([], list(self.store.query('SELECT ?x WHERE { cat eats ?x }')))
+        self.assertEqual(['Robin'], sorted(t for t, in self.store.query(
+            self.PREFIXES + 'SELECT ?t WHERE { robin rdf:type ?t }')))
+    
+    def test_incremental(self):
+        self.store.add_triples(('Animal', self.RDFS + 'subClassOf', 'Thing'),
+                               ('sparrow', self.TYPE, 'Bird'))
+        self.assertEqual(['Animal', 'Bird', 'Thing'], self._types('sparrow'))
+        self.assertEqual(self._closure(), sorted(self.store._inferred().triples()))
+    
+    def test_remove(self):
+        self.store.add_triples(('robin', self.TYPE, 'Animal'))
+        self.store.remove_triples(('Robin', self.RDFS + 'subClassOf', 'Bird'))
+        self.assertEqual(['Animal', 'Food', 'Robin'], self._types('robin'))
+        self.store.remove_triples(('cat', 'devours', 'robin'))
+        self.assertEqual(['Animal', 'Robin'], self._types('robin'))
+        self.assertEqual([], self._types('cat'))
+        self.assertEqual(self._closure(), sorted(self.store._inferred().triples()))
+        self.store.clear_triples()
+        self.assertEqual([], list(self.store._inferred().triples()))
+    
+    def test_without_inference(self):
+        self.assertRaises(ValueError, IndexedTripleStore().query, 'SELECT ?x WHERE { ?x a b }',
+                          inferred=True)
+
+
+class TestNamedGraphs(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = IndexedTripleStore()
+        self.store.add_triples(('g1', 'source', 'web'), ('g2', 'source', 'book'),
+                               ('robin', 'name', 'Default Robin'))
+        self.store.add_quads(('robin', 'name', 'Robin', 'g1'), ('robin', 'color', 'red', 'g1'),
+                             ('robin', 'name', 'Robin', 'g2'), ('robin', 'color', 'brown', 'g2'),
+                             ('eagle', 'name', 'Eagle', 'g2'))
+    
+    def _query(self, q):
+        return sorted(self.store.query(q))
+    
+    def test_graph(self):
+        self.assertEqual([('Default Robin',)], self._query('SELECT ?n WHERE { ?x name ?n }'))
+        self.assertEqual([('red',)], self._query('SELECT ?c WHERE { GRAPH <g1> { robin color ?c } }'))
+        self.assertEqual([('book', 'brown'), ('web', 'red')], self._query(
+            'SELECT ?s ?c WHERE { ?g source ?s GRAPH ?g { robin color ?c } }'))
+        self.assertEqual([('g1', 'Robin'), ('g2', 'Eagle'), ('g2', 'Robin')], self._query(
+            'SELECT ?g ?n WHERE { GRAPH ?g { ?x name ?n } }'))
+        self.assertEqual([], self._query('SELECT ?n WHERE { GRAPH <g3> { ?x name ?n } }'))
+    
+    def test_cached_plans(self):
+        self.assertEqual([('Robin',)], self._query('SELECT ?n WHERE { GRAPH <g1> { ?x name ?n } }'))
+        self.assertEqual([('red',)], self._query('SELECT ?n WHERE { GRAPH <g1> { ?x color ?n } }'))
+        self.assertEqual([('red',)], self._query('SELECT ?c WHERE { GRAPH <g1> { ?x color ?c } }'))
+        self.assertEqual([('brown',)], self._query('SELECT ?c WHERE { GRAPH <g2> { ?x color ?c } }'))
+        self.assertEqual(1, len(self.store._plan_cache._plans))
+    
+    def test_only_graph_partition(self):
+        q = self.store.query('SELECT ?c WHERE { GRAPH <g1> { ?x color ?c } }')
+        self.assertEqual([('red',)], list(q))
+        self.assertEqual(['g1'], q.patterns.plans.keys())
+    
+    def test_from(self):
+        self.assertEqual([('Robin',)], self._query('SELECT ?n FROM <g1> WHERE { ?x name ?n }'))
+        q = 'SELECT ?x ?n FROM <g1> FROM <g2> WHERE { ?x name ?n }'
+        self.assertEqual([('eagle', 'Eagle'), ('robin', 'Robin')], self._query(q))
+        self.store.remove_quads(('robin', 'name', 'Robin', 'g2'))
+        self.assertEqual([('eagle', 'Eagle'), ('robin', 'Robin')], self._query(q))
+        self.store.drop_graph('g1')
+        self.assertEqual([('eagle', 'Eagle')], self._query(q))
+        self.store.add_quads(('sparrow', 'name', 'Sparrow', 'g1'))
+        self.assertEqual([('eagle', 'Eagle'), ('sparrow', 'Sparrow')], self._query(q))
+        self.assertEqual([('g2', 'book')], self._query(
+            'SELECT ?g ?s WHERE { GRAPH ?g { eagle name ?n } ?g source ?s }'))
+    
+    def test_import(self):
+        store = IndexedTripleStore()
+        store.import_file(['robin name Robin .\n'], graph='birds')
+        self.assertEqual([('robin', 'name', 'Robin', 'birds')], list(store.quads()))
+        self.assertEqual(['birds'], store.graphs())
+
+
+class TestImport(unittest.TestCase):
+    
+    def _triples(self, source):
+        return list(TurtleParser(source).triples())
+    
+    def test_terms(self):
+        triples = self._triples(TURTLE.splitlines(True))
+        self.assertEqual(16, len(triples))
+        robin = IRI('http://example.org/robin')
+        self.assertEqual((robin, 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type',
+                          'http://example.org/Bird'), triples[0])
+        self.assertTrue(all(isinstance(t, IRI) for t in triples[0]))
+        names = [t[2] for t in triples if t[1] == 'http://example.org/name']
+        self.assertEqual(['Robin', 'Rouge-gorge', 'anon\xc3\xa9'], [str(n) for n in names])
+        self.assertEqual(['en', 'fr'], [n.lang for n in names[:2]])
+        self.assertNotEqual(LangString('a', 'en'), LangString('a', 'fr'))
+        values = dict((t[1], t[2]) for t in triples if t[0] == robin)
+        self.assertEqual(2, values['http://example.org/legs'])
+        self.assertEqual(15.0, values['http://example.org/weight'])
+        self.assertEqual('two\nlines with "quotes"', values['http://example.org/note'])
+        self.assertEqual('http://example.org/custom', values['http://example.org/code'].datatype)
+        self.assertTrue(isinstance(triples[7][0], BlankNode))
+        self.assertEqual(triples[7][0], triples[8][2])
+        self.assertEqual(('http://example.org/s', 'http://example.org/p', True), triples[-2])
+        self.assertEqual(('robin', 'name', 'Robin'), triples[-1])
+        self.assertFalse(isinstance(triples[-1][0], IRI))
+    
+    def test_mixed_type_equality(self):
+        chat = LangString('chat', 'en')
+        code = TypedLiteral('x', 'http://t')
+        self.assertFalse(chat == 5)
+        self.assertFalse(chat == None)
+        self.assertTrue(chat != 5)
+        self.assertFalse(code == 3.0)
+        self.assertFalse(chat == 'chat' or 'chat' == chat or chat == u'chat')
+        self.assertTrue(chat == LangString('chat', 'en') and chat != LangString('chat', 'fr'))
+        self.assertTrue(code == TypedLiteral('x', 'http://t'))
+        self.assertFalse(code == TypedLiteral('x', 'http://u') or code == 'x' or 'x' == code)
+        self.assertEqual(3, len(set([chat, 'chat', LangString('chat', 'fr'),
+                                     LangString('chat', 'en')])))
+        for store in (TripleStore(), IndexedTripleStore()):
+            store.add_triples(('a', 'label', chat), ('b', 'label', 5), ('c', 'label', code))
+            self.assertEqual([('b',)], list(store.query(
+                'SELECT ?x WHERE { ?x label ?l FILTER (?l = 5) }')))
+            self.assertEqual([], list(store.query(
+                'SELECT ?x WHERE { ?x label ?l FILTER (?l = "chat") }')))
+        triples = ['<r> <n> "Robin" .\n', '<r> <n> "Robin"@en .\n', '<r> <n> "Robin"@fr .\n',
+                   '<r> <n> "Robin"^^<http://t> .\n']
+        for store in (TripleStore(), IndexedTripleStore()):
+            store.import_file(triples)
+            self.assertEqual(4, len(list(store.triples())))
+    
+    def test_long_strings_ending_in_quotes(self):
+        self.assertEqual([('a', 'b', 'ends with "quote"'), ('a', 'b', "x''")], [
+            tuple(t) for t in self._triples(['<a> <b> """ends with "quote"""" .\n',
+                                             "<a> <b> '''x''''' .\n"])])
+    
+    def test_chunk_boundaries(self):
+        from StringIO import StringIO
+        named = lambda triples: [repr(t) for t in triples
+                                 if not any(isinstance(term, BlankNode) for term in t)]
+        expected = named(self._triples([TURTLE]))
+        for size in (1, 2, 3, 7):
+            parser = TurtleParser(StringIO(TURTLE))
+            parser.CHUNK = size
+            self.assertEqual(expected, named(parser.triples()))
+    
+    def test_blank_nodes_per_document(self):
+        store = IndexedTripleStore()
+        store.import_file(['_:a name first .\n'])
+        store.import_file(['_:a name second .\n'])
+        self.assertEqual(2, len(list(store.query('SELECT ?x WHERE { ?x name ?n }'))))
+    
+    def test_files_closed(self):
+        import tempfile, gzip, shutil, minisparql
+        from StringIO import StringIO
+        directory = tempfile.mkdtemp()
+        opened = []
+        open_data = minisparql._open_data
+        minisparql._open_data = lambda source: opened.append(open_data(source)) or opened[-1]
+        try:
+            path = os.path.join(directory, 'birds.ttl')
+            with open(path, 'wb') as f:
+                f.write(TURTLE)
+            f = gzip.open(path + '.gz', 'wb')
+            f.write(TURTLE)
+            f.close()
+            given = StringIO(TURTLE)
+            store = IndexedTripleStore()
+            for source in (path, path + '.gz', given):
+                store.import_file(source)
+            self.assertEqual([True, True, False], [f.closed for f in opened])
+        finally:
+            minisparql._open_data = open_data
+            shutil.rmtree(directory)
+    
+    def test_import_gzip(self):
+        import tempfile, gzip, shutil
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'birds.ttl.gz')
+            f = gzip.open(path, 'wb')
+            f.write(TURTLE)
+            f.close()
+            store = IndexedTripleStore()
+            store.import_file(path)
+            self.assertEqual(16, len(list(store.triples())))
+            self.assertEqual([(LangString('Robin', 'en'),), (LangString('Rouge-gorge', 'fr'),)],
+                             sorted(store.query('SELECT ?n WHERE { <http://example.org/robin> '
+                                                '<http://example.org/name> ?n }')))
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_import_mapped(self):
+        import tempfile, shutil
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'birds.ttl')
+            f = open(path, 'wb')
+            f.write(TURTLE)
+            f.close()
+            store = IndexedTripleStore()
+            store.import_file(path)
+            triples = list(store.triples())
+            self.assertEqual(16, len(triples))
+            subjects = [t[0] for t in triples if t[0] == 'http://example.org/robin']
+            self.assertTrue(all(s is subjects[0] for s in subjects))
+            f = open(path, 'ab')
+            f.write('robin likes } .\n')
+            f.close()
+            try:
+                store.import_file(path)
+                self.fail()
+            except ParseException, e:
+                self.assertTrue('line 12' in str(e))
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_errors(self):
+        self.assertRaises(ParseException, self._triples, ['a b c\n'])
+        self.assertRaises(ParseException, self._triples, ['a b "c .\n'])
+        self.assertRaises(ParseException, self._triples, ['a b } .\n'])
+
+
 class TestPattern(unittest.TestCase):
     
     def setUp(self):
@@ -296,6 +1189,17 @@ class TestUnionGroup(unittest.TestCase):
             [],
             list(self.p.match({'id': 'c'}))
         )
+    
+    def test_many_branches(self):
+        q = self.store.query('SELECT ?id ?v WHERE { { ?id weight ?v } UNION { ?id size ?v } UNION { ?id name ?v } }')
+        self.assertEqual([('a', 'weight-a'), ('b', 'size-b'), ('a', 'name-a'), ('b', 'name-b')], list(q))
+    
+    def test_shared_prefix(self):
+        q = self.store.query('SELECT ?id ?v WHERE { { ?id name ?n . ?id weight ?v } UNION '
+                             '{ ?id name ?n . ?id size ?v } UNION { ?id name ?n . ?id weight ?v } }')
+        self.assertEqual(2, len(q.patterns.patterns))
+        self.assertTrue(isinstance(q.patterns.patterns[1], UnionGroup))
+        self.assertEqual([('a', 'weight-a'), ('a', 'weight-a'), ('b', 'size-b')], sorted(q))
 
 class TestPatternGroup(unittest.TestCase):
 
@@ -451,6 +1355,12 @@ class TestQuery(unittest.TestCase):
                         OPTIONAL {?id weight ?weight . ?id size ?size} }'''))
         )
     
+    def test_plan_is_slotted(self):
+        q = self.store.query('SELECT * WHERE { ?id name ?name OPTIONAL {?id weight ?weight} FILTER (?id != "b") }')
+        self.assertEqual(('id', 'name', 'id', 'weight'), tuple(v.name for v in q.patterns.variables))
+        for node in (q.patterns,) + q.patterns.patterns:
+            self.assertFalse(hasattr(node, '__dict__'))
+    
     def test_star_has_right_column_order(self):
         q = self.store.query('SELECT * WHERE { ?id name ?name }')
         self.assertEqual(('id', 'name'), tuple(v.name for v in q.variables))
@@ -556,6 +1466,147 @@ class TestQuery(unittest.TestCase):
         )
 
 
+class TestQueryLimits(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = IndexedTripleStore()
+        self.store.add_triples(*[('s%d' % i, 'xyz'[i % 3], i) for i in range(100)])
+    
+    def test_unlimited(self):
+        q = self.store.query('SELECT * WHERE { ?a ?b ?c . ?d ?e ?f }')
+        self.assertEqual(100 * 100, len(list(q)))
+    
+    def test_max_rows(self):
+        q = self.store.query('SELECT * WHERE { ?a ?b ?c . ?d ?e ?f }', max_rows=1000)
+        self.assertRaises(QueryTooLarge, list, q)
+    
+    def test_max_rows_not_reached(self):
+        q = self.store.query('SELECT ?a WHERE { ?a y ?c . ?a ?b ?c }', max_rows=1000)
+        self.assertEqual(33, len(list(q)))
+    
+    def test_timeout(self):
+        q = self.store.query('SELECT * WHERE { ?a ?b ?c . ?d ?e ?f }', timeout=0)
+        self.assertRaises(QueryTimeout, list, q)
+    
+    def test_timeout_unindexed(self):
+        store = TripleStore()
+        store.add_triples(*[('s%d' % i, 'p', i) for i in range(1000)])
+        q = store.query('SELECT ?a WHERE { ?a p 999 }', timeout=0)
+        self.assertRaises(QueryTimeout, list, q)
+    
+    def test_max_memory(self):
+        q = self.store.query('SELECT ?c WHERE { ?a ?b ?c } ORDER BY ?c', max_memory=1000)
+        self.assertRaises(QueryTooLarge, list, q)
+        q = self.store.query('SELECT ?c WHERE { ?a ?b ?c } ORDER BY ?c', max_memory=10 ** 6)
+        self.assertEqual(range(100), [c for c, in q])
+    
+    def test_cancel(self):
+        q = self.store.query('SELECT * WHERE { ?a ?b ?c . ?d ?e ?f }')
+        rows = iter(q)
+        next(rows)
+        q.cancel()
+        self.assertRaises(QueryCancelled, list, rows)
+
+class TestRangeFilters(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        self.load([('s%d' % i, 'legs', i) for i in range(20)] +
+                  [('s%d' % i, 'name', 'name-%d' % i) for i in range(20)] +
+                  [('x', 'legs', 'many'), ('y', 'size', 5)])
+    
+    def _check(self, q, expected):
+        self.compare(q, RangePattern, first=True, expected=expected)
+    
+    def test_range(self):
+        self._check('SELECT ?legs WHERE { ?id legs ?legs FILTER (?legs >= 2 && ?legs < 5) }',
+                    [(2,), (3,), (4,)])
+        self._check('SELECT ?legs WHERE { ?id legs ?legs FILTER (?legs > 2 && ?legs <= 5) }',
+                    [(3,), (4,), (5,)])
+        self._check('SELECT ?legs WHERE { ?id legs ?legs FILTER (17 < ?legs) }',
+                    [(18,), (19,), ('many',)])
+        self._check('SELECT ?legs WHERE { ?id legs ?legs FILTER (?legs = 7) }',
+                    [(7,)])
+        self._check('SELECT ?legs WHERE { ?id legs ?legs FILTER (?legs > 2 && ?legs > 16 && ?legs < 18) }',
+                    [(17,)])
+    
+    def test_range_join(self):
+        self._check('SELECT ?name WHERE { ?id name ?name . ?id legs ?legs FILTER (?legs < 2) }',
+                    [('name-0',), ('name-1',)])
+    
+    def test_range_not_used_when_bound(self):
+        q = self.store.query('SELECT ?legs WHERE { ?id name "name-3" . ?id legs ?legs FILTER (?legs < 5) }')
+        self.assertFalse(isinstance(q.patterns.patterns[0], RangePattern))
+        self.assertTrue(isinstance(q.patterns.patterns[1], RangePattern))
+        self.assertEqual([(3,)], list(q))
+    
+    def test_range_index(self):
+        import threading
+        from minisparql import _RangeIndex
+        ranges = _RangeIndex()
+        for i in range(2000):
+            ranges.add('s%d' % i, i)
+        ranges.remove('s5', 5)
+        ranges.add('t', 5)
+        ranges.remove('s6', 6)
+        ranges.add('s6', 6)
+        self.assertEqual([('s4', 4), ('t', 5), ('s6', 6)], list(ranges.range((4, True), (6, True))))
+        results = []
+        def read():
+            results.append(list(ranges.range(None, None)))
+        for i in range(2000, 3000):
+            ranges.add('s%d' % i, i)
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for rows in results:
+            self.assertEqual(3000, len(rows))
+            self.assertTrue(all(s[1:] == str(o) for s, o in rows if s != 't'))
+
+class TestTextIndex(StoreComparison, unittest.TestCase):
+    
+    def setUp(self):
+        self.load([('robin', 'name', 'Robin'), ('sparrow', 'name', 'Sparrow'),
+                   ('eagle', 'name', 'Eagle'), ('bluetit', 'name', 'Blue tit'),
+                   ('robin', 'color', 'red'), ('eagle', 'legs', 2)],
+                  IndexedTripleStore(text_index=True))
+    
+    def _check(self, q, expected, indexed=True):
+        self.compare(q, TextPattern, indexed, first=True, expected=expected)
+    
+    def test_regex(self):
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER regex(?name, "rob", "i") }',
+                    [('Robin',)])
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER regex(?name, "^Spa.*ow$") }',
+                    [('Sparrow',)])
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER regex(?name, "rob") }',
+                    [])
+        self._check('SELECT ?id WHERE { ?id ?p ?name . ?id name ?name FILTER regex(?name, "Blue\\\\s?tit") }',
+                    [('bluetit',)])
+    
+    def test_regex_without_literal(self):
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER regex(?name, "r|t") }',
+                    [('Sparrow',), ('Blue tit',)])
+    
+    def test_contains(self):
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER contains(?name, "arr") }',
+                    [('Sparrow',)])
+        self._check('SELECT ?id WHERE { ?id color ?c . ?id name ?name FILTER (contains(?name, "obi") && ?c = "red") }',
+                    [('robin',)])
+    
+    def test_non_string_arguments(self):
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER contains(?name, 5) }', [])
+        self._check('SELECT ?name WHERE { ?id name ?name FILTER regex(?name, 5) }', [])
+    
+    def test_required_literal(self):
+        from minisparql import _required_literal
+        for pattern, expected in [('robin', 'robin'), ('^rob.n$', 'rob'),
+                                  ('abcd?ef', 'abc'), ('ab(cdefg)?hij', 'hij'),
+                                  ('x{2,3}yyyz', 'yyyz'), ('[abcd]efgh', 'efgh'),
+                                  ('a\\.bc', 'a.bc'), ('ab\\dcd', None), ('ab|cd', None)]:
+            self.assertEqual(expected, _required_literal(pattern))
+
 
 class TestIndex(unittest.TestCase):
     
@@ -569,11 +1620,11 @@ class TestIndex(unittest.TestCase):
     
     def test_insert(self):
         self.index.insert(('a', 'b', 'c'))
-        self.assertEqual({ 'a': { 'b': { 'c': ('a', 'b', 'c') } } },
+        self.assertEqual({ 'a': { 'b': { 'c': 1 } } },
                          self.index._index)
         
         self.index2.insert(('a', 'b', 'c'))
-        self.assertEqual({ 'c': { 'a': { 'b': ('a', 'b', 'c') } } },
+        self.assertEqual({ 'c': { 'a': { 'b': 1 } } },
                          self.index2._index)
     
     def _check_match_full(self, index):
@@ -610,20 +1661,20 @@ class TestIndex(unittest.TestCase):
         self.assertEqual(
             set([('a', 'b', 'c'),
                  ('a', 'b', 'b')]),
-            set(self.index.match(('a', 'b', None)))
+            set(self.index.match(('a', 'b', UNBOUND)))
         )
         self.assertEqual(
             set([('a', 'b', 'c'),
                  ('a', 'b', 'b'),
                  ('a', 'a', 'b')]),
-            set(self.index.match(('a', None, None)))
+            set(self.index.match(('a', UNBOUND, UNBOUND)))
         )
         self.assertEqual(
             set([('a', 'b', 'c'),
                  ('c', 'c', 'c'),
                  ('a', 'b', 'b'),
                  ('a', 'a', 'b')]),
-            set(self.index.match((None, None, None)))
+            set(self.index.match((UNBOUND, UNBOUND, UNBOUND)))
         )
     
     def test_key_error_if_not_indexed(self):
@@ -634,17 +1685,17 @@ class TestIndex(unittest.TestCase):
         
         self.assertEqual(
             set([('a', 'b', 'c')]),
-            set(self.index2.match(('a', None, 'c')))
+            set(self.index2.match(('a', UNBOUND, 'c')))
         )
         
         try:
-            set(self.index2.match(('a', 'b', None)))
+            set(self.index2.match(('a', 'b', UNBOUND)))
             self.fail('This index should not work with provided match')
         except LookupError:
             pass
         
         try:
-            set(self.index2.match((None, 'b', 'c')))
+            set(self.index2.match((UNBOUND, 'b', 'c')))
             self.fail('This index should not work with provided match')
         except LookupError:
             pass
@@ -705,5 +1756,255 @@ class TestPackratDoesNotCauseProblems(unittest.TestCase):
         self.assertEqual([('a2', 'foaf:name', 'name-a2')],
                           list(q2))
     
+    def test_packrat_is_scoped(self):
+        from pyparsing import ParserElement
+        self.store1.query('SELECT ?x WHERE { ?x ?p ?o }')
+        self.assertFalse(ParserElement._packratEnabled)
+    
+    def test_failed_parse_not_cached(self):
+        from minisparql import _parse_state
+        self.assertRaises(ParseException, self.store1.parse_query, 'SELECT ?x WHERE {')
+        self.assertEqual({}, _parse_state.cache)
+        self.assertTrue(_parse_state.store is None)
+        q = self.store2.query('SELECT ?x WHERE { ?x ?p ?o }')
+        self.assertEqual([('a2',)], list(q))
+    
+
+class TestStartup(unittest.TestCase):
+    
+    def run_python(self, *args):
+        import subprocess, sys
+        p = subprocess.Popen((sys.executable,) + args, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        out = p.communicate('a b c .\n')[0]
+        self.assertEqual(0, p.returncode)
+        return out
+    
+    def test_grammar_built_on_first_use(self):
+        self.assertEqual('None\n', self.run_python('-c', 'import minisparql; '
+                                                 'print minisparql._parse_state.grammar'))
+    
+    def test_grammar_built_once(self):
+        import minisparql
+        state = minisparql._parse_state
+        build = minisparql._query_parser
+        built = []
+        def counting():
+            built.append(1)
+            return build()
+        saved = state.grammar
+        minisparql._query_parser = counting
+        state.grammar = None
+        try:
+            store = IndexedTripleStore()
+            store.parse_query('SELECT ?x WHERE { ?x ?p ?o }')
+            grammar = state.grammar
+            store.parse_query('SELECT ?y WHERE { ?y ?p ?o }')
+            IndexedTripleStore().parse_query('SELECT ?z WHERE { ?z ?p ?o }')
+            self.assertTrue(grammar is state.grammar)
+            self.assertEqual(1, len(built))
+        finally:
+            minisparql._query_parser = build
+            state.grammar = saved
+    
+    def test_script(self):
+        out = self.run_python('minisparql.py', '-e', 'SELECT ?x WHERE { ?x b ?y }')
+        self.assertTrue("'a'" in out)
+    
+    def test_memoized_results_copied(self):
+        from pyparsing import Word, alphas, Literal as L
+        from minisparql import _memoize, _parse_state
+        a = Word(alphas)
+        grammar = _memoize((a + a + L('1')) | (a + a + L('2')) | (a + L('y') + L('3')))
+        try:
+            self.assertEqual(['x', 'y', '3'], list(grammar.parseString('x y 3')))
+        finally:
+            _parse_state.cache.clear()
+    
+
+
+class TestQueryPool(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = IndexedTripleStore()
+        self.store.add_triples(('a', 'name', 'name-a'), ('b', 'name', 'name-b'),
+                    ('a', 'weight', 'weight-a'))
+        self.pool = QueryPool(self.store, 2)
+    
+    def tearDown(self):
+        self.pool.close()
+    
+    def test_query(self):
+        q = 'SELECT ?id ?name WHERE { ?id name ?name }'
+        result = self.pool.query(q)
+        self.assertEqual(('id', 'name'), tuple(v.name for v in result.variables))
+        self.assertEqual(list(self.store.query(q)), list(result))
+    
+    def test_query_async(self):
+        pending = [self.pool.query_async('SELECT ?id WHERE { ?id %s ?v }' % p)
+                   for p in ('name', 'weight', 'size')]
+        self.assertEqual([[('a',), ('b',)], [('a',)], []],
+                         [list(p.get()) for p in pending])
+    
+    def test_parse_error(self):
+        self.assertRaises(ParseException, self.pool.query, 'SELECT WHERE')
+    
+    def test_serve_queries_after_failure(self):
+        import sys
+        from StringIO import StringIO
+        from minisparql import serve_queries
+        match_triples = self.store.match_triples
+        def failing(pattern, existing=None):
+            if pattern[1].resolve(existing) == 'weight':
+                raise RuntimeError('broken')
+            return match_triples(pattern, existing)
+        self.store.match_triples = failing
+        out = StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            serve_queries(self.store, ['SELECT ?id WHERE { ?id weight ?w }\n',
+                                       'SELECT WHERE\n',
+                                       'SELECT ?id WHERE { ?id name ?n }\n'], 2)
+        finally:
+            sys.stdout = stdout
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Query failed: RuntimeError'))
+        self.assertEqual(['id', "'a'", "'b'"], lines[-3:])
+
+
+class TestResultWriters(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = IndexedTripleStore()
+        self.store.add_triples(('robin', 'name', 'Robin'), ('robin', 'legs', 2),
+                               ('robin', 'label', LangString('rouge, gorge', 'fr')),
+                               ('sparrow', 'name', u'Spa\xe9rrow'), ('sparrow', 'legs', 2.5),
+                               ('sparrow', 'home', IRI('http://example.org/nest')))
+    
+    def _write(self, q, format):
+        from StringIO import StringIO
+        out = StringIO()
+        write_results(self.store.query(q), out, format)
+        return out.getvalue()
+    
+    def test_formats(self):
+        q = 'SELECT ?id ?legs ?l WHERE { ?id legs ?legs OPTIONAL { ?id label ?l } } ORDER BY ?id'
+        self.assertEqual("id, legs, l\n'robin', 2, 'rouge, gorge'@fr\n'sparrow', 2.5, None\n",
+                         self._write(q, 'text'))
+        self.assertEqual('id,legs,l\r\nrobin,2,"rouge, gorge"\r\nsparrow,2.5,\r\n',
+                         self._write(q, 'csv'))
+        self.assertEqual('?id\t?legs\t?l\n"robin"\t2\t"rouge, gorge"@fr\n"sparrow"\t2.5\t\n',
+                         self._write(q, 'tsv'))
+        import json
+        bindings = json.loads(self._write(q, 'json'))['results']['bindings']
+        self.assertEqual({'type': 'literal', 'xml:lang': 'fr', 'value': 'rouge, gorge'},
+                         bindings[0]['l'])
+        self.assertEqual(2, len(bindings))
+    
+    def test_binary(self):
+        from StringIO import StringIO
+        rows = [('a', 1, 1.5, True, None, u'\xe9', 1 << 70, IRI('http://x'),
+                 BlankNode('_:b'), LangString('chat', 'en'), TypedLiteral('x', 'http://t'))] * 3
+        rows.append((None,) * 11)
+        names = ['v%s' % c for c in 'abcdefghijk']
+        class Query(object):
+            variables = [VariableExpression(n) for n in names]
+            def __iter__(self):
+                return iter(rows * RESULT_BATCH)
+        out = StringIO()
+        write_results(Query(), out, 'binary')
+        read_names, read_rows = read_binary_results(StringIO(out.getvalue()))
+        read_rows = list(read_rows)
+        self.assertEqual(names, read_names)
+        self.assertEqual(rows * RESULT_BATCH, read_rows)
+        self.assertEqual(['str', 'int', 'float', 'bool', 'NoneType', 'unicode', 'long', 'IRI',
+                          'BlankNode', 'LangString', 'TypedLiteral'],
+                         [type(v).__name__ for v in read_rows[0]])
+        self.assertEqual('en', read_rows[-2][9].lang)
+
+
+class TestSparqlServer(unittest.TestCase):
+    
+    def setUp(self):
+        import threading
+        self.store = IndexedTripleStore()
+        self.store.add_triples(('a', 'name', 'name, a'), ('b', 'name', 'name-b'),
+                    ('a', 'height', 100))
+        self.server = sparql_server(self.store, ('127.0.0.1', 0))
+        self.server.RequestHandlerClass.log_message = lambda *args: None
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/sparql' % self.server.server_address[1]
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def _get(self, q, fmt=None, headers={}):
+        import urllib, urllib2
+        params = dict(query=q)
+        if fmt:
+            params['format'] = fmt
+        request = urllib2.Request(self.url + '?' + urllib.urlencode(params), headers=headers)
+        response = urllib2.urlopen(request)
+        return response.info().gettype(), response.read()
+    
+    def test_json(self):
+        import json
+        content_type, body = self._get('SELECT ?id ?height WHERE { ?id name ?name OPTIONAL { ?id height ?height } }')
+        self.assertEqual('application/sparql-results+json', content_type)
+        results = json.loads(body)
+        self.assertEqual(['id', 'height'], results['head']['vars'])
+        self.assertEqual([{'id': {'type': 'literal', 'value': 'a'},
+                           'height': {'type': 'literal', 'value': '100',
+                                      'datatype': 'http://www.w3.org/2001/XMLSchema#integer'}},
+                          {'id': {'type': 'literal', 'value': 'b'}}],
+                         results['results']['bindings'])
+    
+    def test_csv(self):
+        content_type, body = self._get('SELECT ?id ?name WHERE { ?id name ?name }', 'csv')
+        self.assertEqual('text/csv', content_type)
+        self.assertEqual('id,name\r\na,"name, a"\r\nb,name-b\r\n', body)
+    
+    def test_tsv_from_accept(self):
+        content_type, body = self._get('SELECT ?id ?height WHERE { ?id height ?height }',
+                                       headers={'Accept': 'text/tab-separated-values'})
+        self.assertEqual('text/tab-separated-values', content_type)
+        self.assertEqual('?id\t?height\n"a"\t100\n', body)
+    
+    def test_post(self):
+        import urllib2
+        request = urllib2.Request(self.url, 'SELECT ?id WHERE { ?id height 100 }',
+                                  {'Content-Type': 'application/sparql-query',
+                                   'Accept': 'text/csv'})
+        self.assertEqual('id\r\na\r\n', urllib2.urlopen(request).read())
+    
+    def test_bad_query(self):
+        import urllib2
+        try:
+            self._get('SELECT WHERE')
+            self.fail('expected a 400 response')
+        except urllib2.HTTPError, e:
+            self.assertEqual(400, e.code)
+    
+    def _status(self, q):
+        import urllib2
+        try:
+            self._get(q)
+        except urllib2.HTTPError, e:
+            return e.code
+        return 200
+    
+    def test_failed_query(self):
+        self.assertEqual(400, self._status('SELECT ?x WHERE { ?x name ?n FILTER nosuch(?n) }'))
+        def fail(*args):
+            raise RuntimeError('broken')
+        self.store.match_triples = fail
+        self.assertEqual(500, self._status('SELECT ?x WHERE { ?x name ?n }'))
+        del self.store.match_triples
+        self.assertEqual(200, self._status('SELECT ?x WHERE { ?x name ?n }'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file